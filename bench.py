@@ -0,0 +1,534 @@
+"""
+Offline benchmark of the repository builder.
+
+Generates synthetic sync databases, package blobs, AUR and git repositories, serves them from a local
+HTTP server that also answers the AUR RPC interface, and puts stub `makepkg`, `pacman`, `sudo` and
+`repo-add` executables first on PATH. Every phase of a run is then timed against that setup without
+touching the network, a real pacman database or a real build.
+
+Usage:
+    python bench.py [--sizes 100,1000,10000,50000] [--output results.json] [--baseline results.json]
+"""
+
+import argparse
+import hashlib
+import http.server
+import io
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BENCH_PATH = os.path.abspath(__file__)
+# Stub executables are generated to call back into this script
+STUBS = ["makepkg", "pacman", "sudo", "repo-add"]
+REPO_NAME = "bench"
+
+
+def make_package(path: str, pkginfo: dict, payload_size: int = 0):
+    """
+    Writes a zstd compressed package holding a .PKGINFO and a payload file.
+
+    Parameters:
+        path: A string representing the path of the package file.
+        pkginfo: A dictionary mapping .PKGINFO keys to a value or a list of values.
+        payload_size: The size in bytes of the random payload file.
+    """
+    lines = []
+    for key, values in pkginfo.items():
+        for value in values if isinstance(values, list) else [values]:
+            lines.append(f"{key} = {value}")
+
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name, content in [(".PKGINFO", ("\n".join(lines) + "\n").encode("utf-8")),
+                              (f"usr/share/{pkginfo['pkgname']}/payload", os.urandom(payload_size))]:
+            member = tarfile.TarInfo(name)
+            member.size = len(content)
+            member.mtime = int(time.time())
+            tar.addfile(member, io.BytesIO(content))
+
+    if zstandard is not None:
+        with open(path, "wb") as f:
+            f.write(zstandard.ZstdCompressor().compress(buffer.getvalue()))
+    else:
+        with open(path, "wb") as f:
+            subprocess.run(["zstd", "-qc"], input=buffer.getvalue(), stdout=f, check=True)
+
+
+def write_database(path: str, packages: list, compression: str):
+    """
+    Writes a sync database with a `desc` entry for each package.
+
+    Parameters:
+        path: A string representing the path of the database file.
+        packages: A list of dictionaries mapping `desc` fields to a value or a list of values.
+        compression: The tarfile compression of the database, `xz` or `gz`.
+    """
+    with tarfile.open(path, f"w:{compression}") as tar:
+        for package in packages:
+            desc = ""
+            for field, values in package.items():
+                values = values if isinstance(values, list) else [values]
+                if len(values) > 0:
+                    desc += f"%{field}%\n" + "\n".join(values) + "\n\n"
+            content = desc.encode("utf-8")
+            member = tarfile.TarInfo(f"{package['NAME']}-{package['VERSION']}/desc")
+            member.size = len(content)
+            tar.addfile(member, io.BytesIO(content))
+
+
+def write_srcinfo(path: str, pkgbase: str, pkgnames: list, depends: list, source: str = None):
+    """
+    Writes a PKGBUILD and its .SRCINFO to the given folder.
+    """
+    os.makedirs(path, exist_ok=True)
+    with open(f"{path}/PKGBUILD", "w") as f:
+        f.write(f"pkgbase={pkgbase}\npkgname=({' '.join(pkgnames)})\npkgver=1.0\npkgrel=1\narch=(x86_64)\n"
+                f"depends=({' '.join(repr(dep) for dep in depends)})\n")
+
+    srcinfo = f"pkgbase = {pkgbase}\n\tpkgver = 1.0\n\tpkgrel = 1\n\tarch = x86_64\n"
+    srcinfo += "".join(f"\tdepends = {dep}\n" for dep in depends)
+    srcinfo += f"\tsource = {source or f'https://sources.invalid/{pkgbase}-1.0.tar.gz'}\n"
+    srcinfo += "".join(f"\npkgname = {pkgname}\n" for pkgname in pkgnames)
+    with open(f"{path}/.SRCINFO", "w") as f:
+        f.write(srcinfo)
+
+
+def make_git_repository(work: str, dest: str):
+    """
+    Commits the given work tree and publishes it as a bare repository servable over dumb HTTP.
+    """
+    git = "git -c user.name=bench -c user.email=bench@localhost"
+    ret = os.system(f"cd {work} && git init --quiet && git add -A && {git} commit --quiet -m init"
+                    f" && git clone --quiet --bare {work} {dest} && git -C {dest} update-server-info")
+    if ret != 0:
+        raise Exception(f"Failed to create git repository {dest}.")
+
+
+class Fixture:
+    def __init__(self, root: str, url: str, mirrors: list, size: int, fetch: int, aur: int, local: int, payload_size: int):
+        self.root = root
+        self.url = url
+        self.mirrors = mirrors
+        self.size = size
+        self.fetch = fetch
+        self.aur = aur
+        self.local = local
+        self.payload_size = payload_size
+        # Package name -> AUR RPC result served by the stand-in
+        self.aur_results = {}
+
+    def generate(self):
+        """
+        Generates the mirror, the pacman sync folder, the AUR, the local PKGBUILDs and the manifest of the benchmark.
+        """
+        rng = random.Random(self.size)
+        mirror = f"{self.root}/www/{REPO_NAME}/os/x86_64"
+        os.makedirs(mirror)
+        os.makedirs(f"{self.root}/sync")
+
+        packages = []
+        for idx in range(self.size):
+            name = f"pkg{idx:05d}"
+            version = f"1.{idx}-1"
+            filename = f"{name}-{version}-x86_64.pkg.tar.zst"
+            package = {
+                "FILENAME": filename, "NAME": name, "BASE": name, "VERSION": version,
+                "DESC": f"Synthetic package {idx}", "CSIZE": "0", "ISIZE": "0", "SHA256SUM": "0" * 64,
+                "URL": "https://example.org", "LICENSE": "MIT", "ARCH": "x86_64", "BUILDDATE": "0",
+                "PACKAGER": "bench", "PROVIDES": [f"lib{name}.so=1-64"],
+                "DEPENDS": [f"pkg{dep:05d}" for dep in rng.sample(range(idx), min(idx, 3))]
+            }
+            start = len(packages)
+            packages.append(package)
+            if idx % 2 == 0:
+                packages.append(dict(package, FILENAME=f"{name}-debug-{version}-x86_64.pkg.tar.zst",
+                                     NAME=f"{name}-debug", DEPENDS=[], PROVIDES=[]))
+
+            # Only the fetched packages and their debug packages get real blobs
+            if idx >= self.fetch:
+                continue
+            for pkg in packages[start:]:
+                make_package(f"{mirror}/{pkg['FILENAME']}",
+                             {"pkgname": pkg["NAME"], "pkgbase": name, "pkgver": version, "arch": "x86_64",
+                              "depend": pkg["DEPENDS"], "provides": pkg["PROVIDES"]}, self.payload_size)
+                pkg["CSIZE"] = str(os.path.getsize(f"{mirror}/{pkg['FILENAME']}"))
+                with open(f"{mirror}/{pkg['FILENAME']}", "rb") as f:
+                    pkg["SHA256SUM"] = hashlib.sha256(f.read()).hexdigest()
+
+        write_database(f"{mirror}/{REPO_NAME}.db.tar.xz", packages, "xz")
+        write_database(f"{self.root}/sync/{REPO_NAME}.db", packages, "gz")
+
+        # Every top level AUR package needs an AUR only library, both depend on the sync packages
+        for idx in range(self.aur):
+            deps = [f"pkg{dep:05d}" for dep in rng.sample(range(self.size), min(self.size, 3))]
+            for name, depends in [(f"aur-lib-{idx}", deps), (f"aur-top-{idx}", deps + [f"aur-lib-{idx}"])]:
+                write_srcinfo(f"{self.root}/src/aur/{name}", name, [name], depends)
+                make_git_repository(f"{self.root}/src/aur/{name}", f"{self.root}/www/aur/{name}.git")
+                self.aur_results[name] = {"Name": name, "PackageBase": name, "Version": "1.0-1",
+                                          "Depends": depends, "MakeDepends": [], "CheckDepends": [],
+                                          "LastModified": 0}
+
+        # Local packages depend on the built AUR packages, the remote split packages on each other
+        for idx in range(self.local):
+            depends = [f"pkg{rng.randrange(self.size):05d}"] + ([f"aur-top-{idx % self.aur}"] if self.aur > 0 else [])
+            write_srcinfo(f"{self.root}/local/local-{idx}", f"local-{idx}", [f"local-{idx}"], depends)
+        write_srcinfo(f"{self.root}/src/bench-remote/a", "remote-a", ["remote-a"], ["pkg00000"],
+                      "https://sources.invalid/remote-1.0.tar.gz")
+        write_srcinfo(f"{self.root}/src/bench-remote/b", "remote-b", ["remote-b", "remote-b-utils"], ["remote-a"],
+                      "https://sources.invalid/remote-1.0.tar.gz")
+        make_git_repository(f"{self.root}/src/bench-remote", f"{self.root}/www/bench-remote.git")
+
+        with open(f"{self.root}/manifest.json", "w") as f:
+            json.dump({
+                "name": REPO_NAME,
+                "repos": {REPO_NAME: [f"{mirror}/$repo/os/x86_64" for mirror in self.mirrors]},
+                "fetch_debug": "background",
+                "fetch": {REPO_NAME: [f"pkg{idx:05d}" for idx in range(self.fetch)]},
+                "build": {
+                    "aur": [f"aur-top-{idx}" for idx in range(self.aur)],
+                    "local": [f"local-{idx}" for idx in range(self.local)],
+                    "remote": [{"url": f"{self.url}/bench-remote.git", "PKGBUILDs": ["a/PKGBUILD", "b/PKGBUILD"]}]
+                }
+            }, f, indent=4)
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    # The fixture currently served, the AUR RPC stand-in answers from its results
+    fixture = None
+    # Files requested below /flaky/ are sent at `throttle` bytes per second and dropped halfway at `drop_rate`
+    throttle = 0
+    drop_rate = 0.0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=f"{self.fixture.root}/www", **kwargs)
+
+    def translate_path(self, path):
+        return super().translate_path(path[len("/flaky"):] if path.startswith("/flaky/") else path)
+
+    def do_GET(self):
+        if self.path.startswith("/aur/rpc"):
+            names = parse_qs(urlparse(self.path).query).get("arg[]", [])
+            results = [self.fixture.aur_results[name] for name in names if name in self.fixture.aur_results]
+            body = json.dumps({"version": 5, "type": "multiinfo", "resultcount": len(results),
+                               "results": results}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        path = self.translate_path(self.path)
+        flaky = self.path.startswith("/flaky/")
+        if not os.path.isfile(path) or ("Range" not in self.headers and not flaky):
+            super().do_GET()
+            return
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r"^bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if match is not None:
+            start = int(match.group(1))
+            end = min(size - 1, int(match.group(2))) if match.group(2) != "" else size - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        # A dropped connection sends half of the body
+        length = end - start + 1
+        if flaky and random.random() < self.drop_rate:
+            length //= 2
+            self.close_connection = True
+        with open(path, "rb") as f:
+            f.seek(start)
+            while length > 0:
+                chunk = f.read(min(length, 64 * 1024))
+                self.wfile.write(chunk)
+                length -= len(chunk)
+                if flaky and self.throttle > 0:
+                    time.sleep(len(chunk) / self.throttle)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def install_stubs(path: str):
+    """
+    Writes the stub executables to the given folder and puts it first on PATH.
+    """
+    os.makedirs(path, exist_ok=True)
+    for stub in STUBS:
+        with open(f"{path}/{stub}", "w") as f:
+            f.write(f"#!/bin/sh\nexec {sys.executable} {BENCH_PATH} --stub {stub} \"$@\"\n")
+        os.chmod(f"{path}/{stub}", 0o755)
+    os.environ["PATH"] = f"{path}:{os.environ['PATH']}"
+
+
+def stub_main(stub: str, args: list) -> int:
+    """
+    Runs a stub executable. The packages installed by the stubs are recorded in the file named by BENCH_INSTALLED.
+
+    Returns:
+        int: The exit status of the stub.
+    """
+    installed_path = os.environ["BENCH_INSTALLED"]
+    installed = set()
+    if os.path.exists(installed_path):
+        with open(installed_path, "r") as f:
+            installed = set(f.read().split())
+
+    def install(names):
+        with open(installed_path, "a") as f:
+            f.write("".join(f"{name}\n" for name in names))
+
+    if stub == "sudo":
+        return subprocess.run(args).returncode
+
+    if stub == "repo-add":
+        return 0
+
+    if stub == "pacman":
+        operation = args[0] if len(args) > 0 else ""
+        targets = [arg for arg in args[1:] if not arg.startswith("-")]
+        if operation in ["-T", "--deptest", "--color=always"]:
+            sys.path.insert(0, os.path.dirname(BENCH_PATH))
+            from build import strip_version_constraint
+            missing = [dep for dep in targets if strip_version_constraint(dep) not in installed]
+            print("\n".join(missing))
+            return 127 if len(missing) > 0 else 0
+        if operation == "-S":
+            sys.path.insert(0, os.path.dirname(BENCH_PATH))
+            from build import strip_version_constraint
+            install(strip_version_constraint(target) for target in targets)
+        elif operation == "-U":
+            # Like pacman, refuse packages whose dependencies are neither installed nor part of the transaction
+            sys.path.insert(0, os.path.dirname(BENCH_PATH))
+            from build import open_decompressed, strip_version_constraint
+            names = [os.path.basename(target).rsplit("-", 3)[0] for target in targets]
+            for target in targets:
+                with open_decompressed(target) as f, tarfile.open(fileobj=f, mode="r|") as tar:
+                    pkginfo = next(tar.extractfile(member).read().decode("utf-8") for member in tar
+                                   if member.name == ".PKGINFO")
+                for line in pkginfo.split("\n"):
+                    key, _, dep = line.partition(" = ")
+                    if key == "depend" and strip_version_constraint(dep) not in installed | set(names):
+                        print(f"error: failed to prepare transaction: {os.path.basename(target)} needs {dep}")
+                        return 1
+            install(names)
+        return 0
+
+    if stub == "makepkg":
+        sys.path.insert(0, os.path.dirname(BENCH_PATH))
+        from build import MakepkgCache, SrcInfo
+        with open(".SRCINFO", "r") as f:
+            text = f.read()
+        if "--printsrcinfo" in args:
+            print(text)
+            return 0
+
+        srcinfo = SrcInfo(text)
+        if "--verifysource" in args:
+            # Sources are "downloaded" to SRCDEST like makepkg does
+            for source in srcinfo.get("source"):
+                filename = MakepkgCache.get_source_filename(source)
+                if filename is not None and not os.path.exists(f"{os.environ['SRCDEST']}/{filename}"):
+                    with open(f"{os.environ['SRCDEST']}/{filename}", "wb") as f:
+                        f.write(os.urandom(int(os.getenv("BENCH_PAYLOAD_SIZE", "0"))))
+            return 0
+
+        time.sleep(float(os.getenv("BENCH_BUILD_SECONDS", "0")))
+        version = f"{srcinfo.get('pkgver')[0]}-{srcinfo.get('pkgrel')[0]}"
+        for pkgname in srcinfo.get_pkgnames():
+            make_package(f"{pkgname}-{version}-x86_64.pkg.tar.zst",
+                         {"pkgname": pkgname, "pkgbase": srcinfo.pkgbase["pkgbase"][0], "pkgver": version,
+                          "arch": "x86_64", "depend": srcinfo.get("depends", pkgname)},
+                         int(os.getenv("BENCH_PAYLOAD_SIZE", "0")))
+        if "-i" in args:
+            install(srcinfo.get_pkgnames())
+        return 0
+
+    return 1
+
+
+class Timer:
+    def __init__(self):
+        self.results = {}
+
+    def measure(self, phase: str, function, *args):
+        """
+        Runs the given function and records its wall time under the given phase.
+
+        Returns:
+            The result of the function.
+        """
+        print(f"Running {phase}...")
+        start = time.perf_counter()
+        result = function(*args)
+        self.results[phase] = time.perf_counter() - start
+        return result
+
+
+def run_size(build, work: str, url: str, size: int, options) -> dict:
+    """
+    Benchmarks every phase of a run against a synthetic mirror of the given size.
+
+    Returns:
+        dict: The wall time in seconds of each phase.
+    """
+    root = f"{work}/{size}"
+    os.makedirs(root)
+    # An unreachable mirror is probed and skipped, the flaky one serves the same files as the primary one
+    mirrors = ([f"{url}/flaky"] if options.drop_rate > 0 or options.throttle > 0 else []) + ["http://127.0.0.1:9", url]
+    fixture = Fixture(root, url, mirrors, size, min(options.fetch, size), options.aur, options.local, options.payload_size)
+    Handler.fixture = fixture
+    timer = Timer()
+    timer.measure("generate", fixture.generate)
+
+    os.chdir(root)
+    os.environ["BENCH_INSTALLED"] = f"{root}/installed"
+    build.PACMAN_SYNC_DIR = f"{root}/sync"
+    build.AUR_URL = f"{url}/aur"
+    build.PKGBUILD_URL = f"{url}/bench-remote.git"
+
+    manifest = build.Manifest("manifest.json")
+    timer.measure("manifest_load", manifest.load)
+    timer.measure("refresh_database_cold", build.Repository, REPO_NAME, manifest.repos[REPO_NAME])
+    timer.measure("refresh_database_warm", build.Repository, REPO_NAME, manifest.repos[REPO_NAME])
+
+    build.prepare_workspace()
+    getter = timer.measure("package_getter", build.PackageGetter, manifest)
+    timer.measure("fetch_cold", getter.fetch_packages_from_repos)
+    timer.measure("fetch_debug_cold", getter.wait_debug_packages)
+    build.prepare_workspace()
+    timer.measure("fetch_warm", getter.fetch_packages_from_repos)
+
+    def resolve():
+        sync_index = build.SyncIndex(build.PACMAN_SYNC_DIR)
+        for package in sync_index.packages.values():
+            sync_index.resolve_versions(package.get("depends", []))
+        resolver = build.AurResolver(build.AUR_URL, f"{root}/resolve/info.json", sync_index)
+        return resolver.resolve(manifest.get_build_list("aur"))
+
+    timer.measure("dependency_resolution", resolve)
+    timer.measure("build", getter.build_packages)
+    timer.measure("fetch_debug_wait", getter.wait_debug_packages)
+    timer.measure("repo_assembly", build.build_repository, manifest.name, False, "", None, getter.digests)
+    timer.measure("repo_assembly_warm", build.build_repository, manifest.name, False, "", None, getter.digests)
+
+    def build_warm():
+        # A fresh container restores every build from the build cache, only the installed packages are gone
+        os.remove(os.environ["BENCH_INSTALLED"])
+        build.prepare_workspace()
+        return getter.build_packages()
+
+    timer.measure("build_warm", build_warm)
+
+    def stage():
+        build.prepare_workspace()
+        return getter.collect_build_targets()
+
+    # Sources are staged again over the build leftovers of the previous run
+    timer.measure("stage_warm", stage)
+    timer.measure("check", build.check)
+
+    os.chdir(work)
+    return timer.results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the repository builder offline.")
+    parser.add_argument("--sizes", default="100,1000,10000,50000", help="Comma separated sync database sizes.")
+    parser.add_argument("--fetch", type=int, default=20, help="Packages fetched from the mirror.")
+    parser.add_argument("--aur", type=int, default=4, help="AUR packages built, each with an AUR dependency.")
+    parser.add_argument("--local", type=int, default=4, help="Local packages built.")
+    parser.add_argument("--payload-size", type=int, default=256 * 1024, help="Payload size of each package.")
+    parser.add_argument("--segment-threshold", type=int, default=128 * 1024,
+                        help="Size from which packages are downloaded in segments.")
+    parser.add_argument("--drop-rate", type=float, default=0,
+                        help="Rate of dropped responses of the flaky mirror, listed when this or --throttle is set.")
+    parser.add_argument("--throttle", type=int, default=0, help="Bytes per second sent by the flaky mirror.")
+    parser.add_argument("--build-seconds", type=float, default=0, help="Time each stub makepkg build sleeps.")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare the results to this JSON file and fail on regressions.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown against the baseline.")
+    parser.add_argument("--keep", action="store_true", help="Keep the working folder.")
+    options = parser.parse_args()
+
+    work = tempfile.mkdtemp(prefix="molyuu-bench-")
+    os.environ["MOLYUU_REPO_CACHE_DIR"] = "cache"
+    os.environ["MOLYUU_REPO_SEGMENT_THRESHOLD"] = str(options.segment_threshold)
+    os.environ["MOLYUU_REPO_FETCH_RETRIES"] = os.getenv("MOLYUU_REPO_FETCH_RETRIES", "1")
+    os.environ["BENCH_BUILD_SECONDS"] = str(options.build_seconds)
+    os.environ["BENCH_PAYLOAD_SIZE"] = str(options.payload_size)
+    install_stubs(f"{work}/bin")
+
+    Handler.drop_rate = options.drop_rate
+    Handler.throttle = options.throttle
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    sys.path.insert(0, os.path.dirname(BENCH_PATH))
+    import build
+
+    results = {}
+    try:
+        for size in [int(size) for size in options.sizes.split(",")]:
+            print(f"Benchmarking {size} packages...")
+            results[str(size)] = run_size(build, work, url, size, options)
+    finally:
+        server.shutdown()
+        if not options.keep:
+            shutil.rmtree(work, ignore_errors=True)
+        else:
+            print(f"Kept {work}")
+
+    phases = list(next(iter(results.values())).keys())
+    print(f"\n{'phase':<24}" + "".join(f"{size:>12}" for size in results))
+    for phase in phases:
+        print(f"{phase:<24}" + "".join(f"{results[size][phase]:>11.3f}s" for size in results))
+
+    if options.output is not None:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if options.baseline is not None:
+        with open(options.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = []
+        for size, phases in results.items():
+            for phase, seconds in phases.items():
+                if phase == "generate" or phase not in baseline.get(size, {}):
+                    continue
+                if seconds > baseline[size][phase] * (1 + options.tolerance):
+                    regressions.append(f"{phase} at {size} packages: {baseline[size][phase]:.3f}s -> {seconds:.3f}s")
+        if len(regressions) > 0:
+            print("Regressions:\n  " + "\n  ".join(regressions))
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    # Stubs pass their arguments through untouched
+    if len(sys.argv) > 2 and sys.argv[1] == "--stub":
+        sys.exit(stub_main(sys.argv[2], sys.argv[3:]))
+    sys.exit(main())
@@ -1,12 +1,622 @@
+import base64
+import contextlib
+import fcntl
+import fnmatch
+import functools
+import glob
+import gzip
+import io
 import json
+import lzma
 import os
+import queue
 import re
+import shutil
+import stat
 import sys
 import requests
 import subprocess
 import hashlib
+import inspect
 import tarfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from requests.adapters import HTTPAdapter
 from typing import Optional, Tuple
+from urllib.parse import urlparse
+
+try:
+    import zstandard
+except ImportError:
+    # Packages are decompressed through the zstd command instead
+    zstandard = None
+
+# Persistent state that must survive prepare_workspace() resetting the workspace.
+CACHE_DIR = os.getenv("MOLYUU_REPO_CACHE_DIR", "cache")
+FETCH_JOBS = int(os.getenv("MOLYUU_REPO_FETCH_JOBS", "4"))
+FETCH_RETRIES = int(os.getenv("MOLYUU_REPO_FETCH_RETRIES", "3"))
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+SEGMENT_THRESHOLD = int(os.getenv("MOLYUU_REPO_SEGMENT_THRESHOLD", str(64 * 1024 * 1024)))
+SEGMENT_JOBS = int(os.getenv("MOLYUU_REPO_SEGMENT_JOBS", "4"))
+MIRROR_PROBE_TIMEOUT = int(os.getenv("MOLYUU_REPO_MIRROR_PROBE_TIMEOUT", "5"))
+BUILD_JOBS = int(os.getenv("MOLYUU_REPO_BUILD_JOBS", "2"))
+AUR_URL = os.getenv("MOLYUU_REPO_AUR_URL", "https://aur.archlinux.org")
+AUR_CACHE_TTL = int(os.getenv("MOLYUU_REPO_AUR_CACHE_TTL", "3600"))
+SIGN_JOBS = int(os.getenv("MOLYUU_REPO_SIGN_JOBS", str(os.cpu_count() or 1)))
+PUBLISHED_DB = os.getenv("MOLYUU_REPO_PUBLISHED_DB", "")
+ARTIFACT_STORE = os.getenv("MOLYUU_REPO_ARTIFACT_STORE", "")
+PACMAN_SYNC_DIR = os.getenv("MOLYUU_REPO_PACMAN_SYNC_DIR", "/var/lib/pacman/sync")
+SRCDEST_MAX_SIZE = int(os.getenv("MOLYUU_REPO_SRCDEST_MAX_SIZE", str(4 * 1024 * 1024 * 1024)))
+CCACHE_MAX_SIZE = os.getenv("MOLYUU_REPO_CCACHE_MAX_SIZE", "2G")
+# Fingerprint of the inputs of the last successful run, see check()
+FINGERPRINT_PATH = os.getenv("MOLYUU_REPO_FINGERPRINT", f"{CACHE_DIR}/fingerprint.json")
+PKGBUILD_URL = "https://github.com/MolyuuOS/PKGBUILD.git"
+CARCH = "x86_64"
+
+
+class Tracer:
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, **args):
+        """
+        Records the wall time of the enclosed code as a Chrome trace event.
+
+        Parameters:
+            name: A string naming the span, such as the package being built.
+            category: A string grouping related spans, such as `build` or `download`.
+            args: Initial values of the span arguments.
+
+        Returns:
+            A context manager yielding the arguments of the span, which tracer.annotate() also updates.
+        """
+        stack = self.local.__dict__.setdefault("stack", [])
+        event = {"name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                 "ts": (time.perf_counter() - self.origin) * 1e6, "args": dict(args)}
+        stack.append(event)
+        try:
+            yield event["args"]
+        except BaseException as e:
+            event["args"]["error"] = str(e)
+            raise
+        finally:
+            stack.pop()
+            event["dur"] = (time.perf_counter() - self.origin) * 1e6 - event["ts"]
+            with self.lock:
+                self.events.append(event)
+
+    def annotate(self, **args):
+        """
+        Adds arguments to the innermost span of the current thread, numeric values are summed up.
+        """
+        stack = self.local.__dict__.get("stack", [])
+        if len(stack) == 0:
+            return
+        for key, value in args.items():
+            if isinstance(value, (int, float)) and isinstance(stack[-1]["args"].get(key), (int, float)):
+                stack[-1]["args"][key] += value
+            else:
+                stack[-1]["args"][key] = value
+
+    def run(self, command: str, name: str, category: str) -> int:
+        """
+        Runs a shell command like os.system() does, recording its exit code and the peak RSS of its process tree.
+
+        Returns:
+            int: The exit code of the command.
+        """
+        with self.span(name, category) as args:
+            process = subprocess.Popen(command, shell=True)
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            args["exit_code"] = process.returncode
+            args["peak_rss_kb"] = rusage.ru_maxrss
+            return process.returncode
+
+    def report(self, path: str, history_path: str):
+        """
+        Writes the recorded spans as a Chrome trace, appends the cost of each build to the run history
+        and prints the most expensive spans.
+
+        Parameters:
+            path: A string representing the path of the Chrome trace JSON file.
+            history_path: A string representing the path of the JSONL file collecting the cost of every run.
+        """
+        with self.lock:
+            events = sorted(self.events, key=lambda event: event["ts"])
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+        # Keep the traces of the last 30 runs, the history keeps the build costs of every run
+        traces = sorted(glob.glob(f"{os.path.dirname(path)}/trace-*.json"))
+        for trace in traces[:-30]:
+            os.remove(trace)
+
+        with open(history_path, "a") as f:
+            f.write(json.dumps({
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "builds": {event["name"]: round(event["dur"] / 1e6, 3) for event in events if event["cat"] == "build"}
+            }) + "\n")
+
+        totals = {}
+        for event in events:
+            total = totals.setdefault((event["cat"], event["name"]), {"dur": 0, "count": 0, "bytes": 0, "rss": 0})
+            total["dur"] += event["dur"]
+            total["count"] += 1
+            total["bytes"] += event["args"].get("bytes", 0)
+            total["rss"] = max(total["rss"], event["args"].get("peak_rss_kb", 0))
+
+        print(f"{'Seconds':>10}  {'Calls':>5}  {'MiB':>9}  {'Peak RSS MiB':>12}  {'Category':<12}  Name")
+        for (category, name), total in sorted(totals.items(), key=lambda item: -item[1]["dur"])[:30]:
+            print(f"{total['dur'] / 1e6:>10.2f}  {total['count']:>5}  {total['bytes'] / 1048576:>9.1f}  "
+                  f"{total['rss'] / 1024:>12.1f}  {category:<12}  {name}")
+        print(f"Trace written to {path}")
+
+
+tracer = Tracer()
+
+
+def traced(category: str, name: str):
+    """
+    Decorator recording every call of the decorated function as a span.
+
+    Parameters:
+        category: A string with the category of the span.
+        name: A format string for the span name, formatted with the arguments of the call such as `{self.name}`.
+    """
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            with tracer.span(name.format(**bound.arguments), category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def load_srcinfo(pkgbuild_dir: str) -> "SrcInfo":
+    """
+    Loads the .SRCINFO of the PKGBUILD located in the given directory.
+    A committed .SRCINFO is used as is, otherwise it is generated once per PKGBUILD content and cached,
+    since every `makepkg --printsrcinfo` has to source the PKGBUILD through bash.
+
+    Parameters:
+        pkgbuild_dir: A string representing the path to the directory containing the PKGBUILD file.
+
+    Returns:
+        SrcInfo: The parsed .SRCINFO.
+    """
+    if os.path.exists(f"{pkgbuild_dir}/.SRCINFO"):
+        with open(f"{pkgbuild_dir}/.SRCINFO", "r") as f:
+            return SrcInfo(f.read())
+
+    with open(f"{pkgbuild_dir}/PKGBUILD", "rb") as f:
+        cached = f"{CACHE_DIR}/srcinfo/{hashlib.sha256(f.read()).hexdigest()}"
+    if os.path.exists(cached):
+        with open(cached, "r") as f:
+            return SrcInfo(f.read())
+
+    srcinfo = subprocess.check_output(f"cd {pkgbuild_dir} && makepkg --printsrcinfo", shell=True, text=True)
+    os.makedirs(os.path.dirname(cached), exist_ok=True)
+    with open(f"{cached}.{threading.get_ident()}", "w") as f:
+        f.write(srcinfo)
+    os.replace(f"{cached}.{threading.get_ident()}", cached)
+    return SrcInfo(srcinfo)
+
+
+def strip_version_constraint(dep: str) -> str:
+    """
+    Returns the package name of a dependency string such as `foo>=1.0`.
+    """
+    return re.split(r"[<>=]", dep, 1)[0]
+
+
+def parse_dependency(dep: str) -> Tuple[str, Optional[str], Optional[str]]:
+    """
+    Splits a dependency string such as `foo>=1.0` into its name, comparison operator and version.
+
+    Returns:
+        A tuple with the name, the operator and the version, operator and version are None for unversioned dependencies.
+    """
+    match = re.match(r"^([^<>=]+)(<=|>=|<|>|=)(.+)$", dep)
+    if match is None:
+        return (dep, None, None)
+    return (match.group(1), match.group(2), match.group(3))
+
+
+def rpmvercmp(a: str, b: str) -> int:
+    """
+    Compares two version segments the way libalpm's rpmvercmp() does.
+
+    Returns:
+        int: -1 if `a` is older than `b`, 0 if they are equal, 1 if `a` is newer than `b`.
+    """
+    if a == b:
+        return 0
+
+    def isalpha(s, i):
+        return i < len(s) and ("a" <= s[i] <= "z" or "A" <= s[i] <= "Z")
+
+    def isdigit(s, i):
+        return i < len(s) and "0" <= s[i] <= "9"
+
+    one = two = 0
+    ptr1 = ptr2 = 0
+    while one < len(a) and two < len(b):
+        while one < len(a) and not (isalpha(a, one) or isdigit(a, one)):
+            one += 1
+        while two < len(b) and not (isalpha(b, two) or isdigit(b, two)):
+            two += 1
+
+        if one >= len(a) or two >= len(b):
+            break
+
+        # If the separator lengths were different, we are also finished
+        if one - ptr1 != two - ptr2:
+            return -1 if one - ptr1 < two - ptr2 else 1
+
+        ptr1 = one
+        ptr2 = two
+        isnum = isdigit(a, ptr1)
+        if isnum:
+            while isdigit(a, ptr1):
+                ptr1 += 1
+            while isdigit(b, ptr2):
+                ptr2 += 1
+        else:
+            while isalpha(a, ptr1):
+                ptr1 += 1
+            while isalpha(b, ptr2):
+                ptr2 += 1
+
+        # Numeric segments are always newer than alpha segments
+        if two == ptr2:
+            return 1 if isnum else -1
+
+        segment1 = a[one:ptr1]
+        segment2 = b[two:ptr2]
+        if isnum:
+            segment1 = segment1.lstrip("0")
+            segment2 = segment2.lstrip("0")
+            if len(segment1) != len(segment2):
+                return 1 if len(segment1) > len(segment2) else -1
+
+        if segment1 != segment2:
+            return -1 if segment1 < segment2 else 1
+
+        one = ptr1
+        two = ptr2
+
+    if one >= len(a) and two >= len(b):
+        return 0
+
+    # A remaining alpha string never beats an empty string
+    if (one >= len(a) and not isalpha(b, two)) or isalpha(a, one):
+        return -1
+    return 1
+
+
+def vercmp(a: str, b: str) -> int:
+    """
+    Compares two full package versions (`[epoch:]pkgver[-pkgrel]`) the way pacman's vercmp does.
+
+    Returns:
+        int: -1 if `a` is older than `b`, 0 if they are equal, 1 if `a` is newer than `b`.
+    """
+    if a == b:
+        return 0
+
+    def parse_evr(evr):
+        match = re.match(r"^(\d*):(.*)$", evr)
+        epoch, rest = (match.group(1) or "0", match.group(2)) if match is not None else ("0", evr)
+        version, _, release = rest.rpartition("-") if "-" in rest else (rest, None, None)
+        return epoch, version, release
+
+    epoch1, version1, release1 = parse_evr(a)
+    epoch2, version2, release2 = parse_evr(b)
+
+    ret = rpmvercmp(epoch1, epoch2)
+    if ret == 0:
+        ret = rpmvercmp(version1, version2)
+        if ret == 0 and release1 is not None and release2 is not None:
+            ret = rpmvercmp(release1, release2)
+    return ret
+
+
+@contextlib.contextmanager
+def open_decompressed(path: str):
+    """
+    Opens a possibly xz, gzip or zstd compressed file for sequential reading.
+    tarfile's own stream decompression is much slower than reading through lzma or gzip directly.
+
+    Parameters:
+        path: A string representing the path to the file.
+
+    Returns:
+        A context manager yielding a binary file object with the decompressed content.
+    """
+    with open(path, "rb") as f:
+        magic = f.read(6)
+
+    if magic.startswith(b"\xfd7zXZ\x00"):
+        with lzma.open(path, "rb") as f:
+            yield f
+    elif magic.startswith(b"\x1f\x8b"):
+        with gzip.open(path, "rb") as f:
+            yield f
+    elif magic.startswith(b"\x28\xb5\x2f\xfd") and zstandard is not None:
+        with open(path, "rb") as raw, zstandard.ZstdDecompressor().stream_reader(raw) as f:
+            yield f
+    elif magic.startswith(b"\x28\xb5\x2f\xfd"):
+        process = subprocess.Popen(["zstd", "-dcq", path], stdout=subprocess.PIPE)
+        try:
+            yield process.stdout
+        finally:
+            process.stdout.close()
+            process.kill()
+            process.wait()
+    else:
+        with open(path, "rb") as f:
+            yield f
+
+
+# Fields of a sync database `desc` entry that hold one value per line
+DESC_LIST_FIELDS = {
+    "groups", "license", "replaces", "depends", "optdepends", "makedepends",
+    "checkdepends", "conflicts", "provides", "backup", "files"
+}
+
+
+def parse_desc(content: str) -> dict:
+    """
+    Parses a `desc` entry of a sync database.
+
+    Parameters:
+        content: A string with the content of the `desc` entry.
+
+    Returns:
+        A dictionary mapping lowercase field names such as `filename`, `version` or `sha256sum` to their values.
+        Fields listed in DESC_LIST_FIELDS map to lists, every other field maps to a string.
+    """
+    package = {}
+    for section in content.split("\n\n"):
+        lines = section.strip("\n").split("\n")
+        if len(lines) < 2 or not (lines[0].startswith("%") and lines[0].endswith("%")):
+            continue
+
+        field = lines[0][1:-1].lower()
+        package[field] = lines[1:] if field in DESC_LIST_FIELDS else "\n".join(lines[1:])
+
+    return package
+
+
+def file_sha256(path: str) -> str:
+    """
+    Returns the hex encoded SHA256 digest of the file at the given path.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(DOWNLOAD_CHUNK_SIZE):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def link_or_copy(src: str, dest: str):
+    """
+    Hardlinks `src` to `dest`, falling back to a copy when both are on different filesystems.
+    """
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+# ioctl cloning the extents of a file into another on copy-on-write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def clone_file(src: str, dest: str):
+    """
+    Copies `src` to `dest` as a reflink sharing its extents where the filesystem supports it,
+    falling back to a hardlink, then to a copy. Symlinks are recreated.
+    """
+    if os.path.lexists(dest):
+        remove_path(dest)
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dest)
+        return
+
+    try:
+        with open(src, "rb") as s, open(dest, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        shutil.copystat(src, dest)
+        return
+    except OSError:
+        if os.path.exists(dest):
+            os.remove(dest)
+
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+def remove_path(path: str):
+    """
+    Removes a file, a symlink or a whole folder.
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def sync_tree(src: str, dest: str) -> int:
+    """
+    Makes `dest` a copy of the `src` folder, only staging the entries that changed since the last sync
+    (by type, size and modification time) with clone_file(). Entries missing from `src` are discarded to the trash.
+
+    Returns:
+        int: The number of entries staged or discarded.
+    """
+    changed = 0
+    os.makedirs(dest, exist_ok=True)
+    entries = {entry.name: entry for entry in os.scandir(src)}
+    for entry in os.scandir(dest):
+        if entry.name not in entries:
+            trash.discard(entry.path)
+            changed += 1
+
+    for name, entry in entries.items():
+        target = f"{dest}/{name}"
+        if entry.is_dir(follow_symlinks=False):
+            if os.path.lexists(target) and (os.path.islink(target) or not os.path.isdir(target)):
+                remove_path(target)
+            changed += sync_tree(entry.path, target)
+            continue
+
+        if os.path.lexists(target):
+            src_stat = entry.stat(follow_symlinks=False)
+            dest_stat = os.lstat(target)
+            if entry.is_symlink() and os.path.islink(target):
+                if os.readlink(entry.path) == os.readlink(target):
+                    continue
+            elif (stat.S_IFMT(src_stat.st_mode) == stat.S_IFMT(dest_stat.st_mode) and src_stat.st_size == dest_stat.st_size
+                    and src_stat.st_mtime_ns == dest_stat.st_mtime_ns):
+                continue
+            if os.path.isdir(target) and not os.path.islink(target):
+                trash.discard(target)
+        clone_file(entry.path, target)
+        changed += 1
+
+    return changed
+
+
+class Trash:
+    def __init__(self, path: str):
+        self.path = path
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.counter = 0
+
+    def discard(self, path: str):
+        """
+        Moves a file or folder to the trash folder, which is emptied on a background thread.
+        Paths that cannot be moved there, such as paths on another filesystem, are removed right away.
+        """
+        folder = os.path.abspath(self.path)
+        os.makedirs(folder, exist_ok=True)
+        with self.lock:
+            self.counter += 1
+            target = f"{folder}/{time.time_ns()}-{self.counter}"
+
+        try:
+            os.rename(path, target)
+        except OSError:
+            remove_path(path)
+            return
+        self.queue.put(target)
+        self.start()
+
+    def empty(self):
+        """
+        Starts removing what previous runs left in the trash folder in the background.
+        """
+        folder = os.path.abspath(self.path)
+        for name in os.listdir(folder) if os.path.exists(folder) else []:
+            self.queue.put(f"{folder}/{name}")
+        self.start()
+
+    def start(self):
+        """
+        Starts the background thread emptying the trash, unless it already runs.
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            path = self.queue.get()
+            try:
+                remove_path(path)
+            except OSError as e:
+                print(f"Failed to remove {path}: {e}")
+
+
+# Build leftovers and previous trees are deleted in the background, a run killed midway leaves them in the
+# trash folder for the next run
+trash = Trash(".trash")
+
+
+# Number of makepkg processes running, see run_makepkg()
+running_makepkg = 0
+running_makepkg_lock = threading.Lock()
+
+
+def run_makepkg(pkgbuild_dir: str, args: str, env: Optional[dict] = None) -> int:
+    """
+    Runs makepkg in the given directory.
+    MAKEFLAGS splits the cores of the machine between the makepkg processes running when it starts,
+    so a build running alone gets the whole machine, and caps the load average at the number of cores
+    so builds started earlier do not oversubscribe the machine once others join them.
+
+    Parameters:
+        pkgbuild_dir: A string representing the path to the directory containing the PKGBUILD file.
+        args: A string with the arguments passed to makepkg.
+        env: Additional environment variables passed to makepkg.
+
+    Returns:
+        int: The exit status of makepkg.
+    """
+    global running_makepkg
+    cores = os.cpu_count() or 1
+    with running_makepkg_lock:
+        running_makepkg += 1
+        make_jobs = max(1, cores // running_makepkg)
+
+    try:
+        variables = "".join(f" {key}=\"{value}\"" for key, value in (env or {}).items())
+        return tracer.run(f"cd {pkgbuild_dir} && MAKEFLAGS=\"-j{make_jobs} -l{cores}\"{variables} makepkg {args}",
+                          f"makepkg {pkgbuild_dir}", "makepkg")
+    finally:
+        with running_makepkg_lock:
+            running_makepkg -= 1
+
+
+def package_name_from_filename(filename: str) -> str:
+    """
+    Returns the package name of a package file named `{pkgname}-{pkgver}-{pkgrel}-{arch}.pkg.tar.zst`.
+    """
+    return filename.rsplit("-", 3)[0]
+
+
+def move_packages(src: str, dest: str) -> list:
+    """
+    Moves every built package from the `src` directory to the `dest` directory.
+
+    Returns:
+        A list with the filenames of the moved packages.
+    """
+    moved = []
+    for package in sorted(glob.glob(f"{src}/*.pkg.tar.zst")):
+        shutil.move(package, f"{dest}/{os.path.basename(package)}")
+        moved.append(os.path.basename(package))
+    return moved
 
 
 class Manifest:
@@ -15,6 +625,8 @@ class Manifest:
         self.repos = {}
         self.fetch = {}
         self.build = {}
+        # Whether debug packages are fetched: "on", "off" or "background", see PackageGetter.fetch_packages_from_repos()
+        self.fetch_debug = "on"
         self.path = path
 
     def load(self):
@@ -40,6 +652,14 @@ class Manifest:
             if "build" in data:
                 self.build = data["build"]
 
+            if "fetch_debug" in data:
+                fetch_debug = data["fetch_debug"]
+                if isinstance(fetch_debug, bool):
+                    fetch_debug = "on" if fetch_debug else "off"
+                if fetch_debug not in ["on", "off", "background"]:
+                    raise Exception(f"Invalid fetch_debug value: {fetch_debug}")
+                self.fetch_debug = fetch_debug
+
     def get_repos(self) -> list:
         """
         Returns a list of keys from the repos dictionary.
@@ -63,160 +683,1561 @@ class Manifest:
         for _, v in self.fetch.items():
             result = result + v
 
-        for _, v in self.build.items():
-            result = result + v
+        for _, v in self.build.items():
+            result = result + v
+
+        return result if result.__len__() > 0 else None
+
+    def get_build_list(self, src_source: str) -> Optional[list]:
+        """
+        A function that retrieves the build list based on the src_source parameter.
+
+        Parameters:
+            self: instance of the Manifest class
+            src_source: a string representing the source to retrieve the build list from
+
+        Returns:
+            An optional list of build items associated with the src_source if found, otherwise None.
+        """
+        if src_source not in self.build:
+            return None
+        return list(self.build.get(src_source))
+
+
+class Repository:
+    # Keep-alive sessions shared by every repository on the same host
+    sessions = {}
+    sessions_lock = threading.Lock()
+    # Bumped whenever the layout of the parsed database index changes
+    INDEX_FORMAT = 3
+    DATABASE_FILENAME = "{name}.db.tar.xz"
+
+    def __init__(self, name: str, url):
+        """
+        Parameters:
+            name: A string representing the name of the repository.
+            url: The URL template of the repository, or a list of the URL templates of its mirrors.
+                 `$repo` is replaced by the name of the repository.
+        """
+        self.name = name
+        self.mirrors = [mirror.replace('$repo', name) for mirror in (url if isinstance(url, list) else [url])]
+        self.mirrors_lock = threading.Lock()
+        if len(self.mirrors) > 1:
+            self.mirrors = self.rank_mirrors(self.mirrors)
+        self.url = self.mirrors[0]
+        self.packages = {}
+        self.refresh_database()
+
+    @classmethod
+    def get_session(cls, url: str) -> requests.Session:
+        """
+        Returns the keep-alive session used for every download from the host of the given URL.
+
+        Parameters:
+            url: A string representing the URL to be downloaded.
+
+        Returns:
+            A requests.Session with a connection pool sized for concurrent fetches.
+        """
+        host = urlparse(url).netloc
+        with cls.sessions_lock:
+            if host not in cls.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=FETCH_JOBS * SEGMENT_JOBS)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                cls.sessions[host] = session
+            return cls.sessions[host]
+
+    def rank_mirrors(self, mirrors: list) -> list:
+        """
+        Probes the mirrors concurrently for the database of the repository and orders them by latency.
+
+        Parameters:
+            mirrors: A list of the URLs of the mirrors.
+
+        Returns:
+            list: The mirrors ordered from the fastest to the slowest, unreachable mirrors last.
+        """
+        database_filename = self.DATABASE_FILENAME.format(name=self.name)
+
+        def probe(mirror):
+            url = f"{mirror}/{database_filename}"
+            try:
+                start = time.monotonic()
+                r = self.get_session(url).head(url, timeout=MIRROR_PROBE_TIMEOUT, allow_redirects=True)
+                r.raise_for_status()
+                return time.monotonic() - start
+            except requests.RequestException:
+                return None
+
+        with ThreadPoolExecutor(max_workers=mirrors.__len__()) as executor:
+            latencies = dict(zip(mirrors, executor.map(probe, mirrors)))
+
+        ranked = sorted(mirrors, key=lambda mirror: (latencies[mirror] is None, latencies[mirror] or 0))
+        for mirror in ranked:
+            latency = f"{latencies[mirror] * 1000:.0f} ms" if latencies[mirror] is not None else "unreachable"
+            print(f"Mirror {mirror} of repo {self.name}: {latency}")
+        return ranked
+
+    def download_from_mirrors(self, filename: str, path: str, **kwargs) -> Optional[str]:
+        """
+        Downloads a file of the repository from the first mirror that serves it, see download_file().
+        A failed download fails over to the next mirror right away, and every mirror is retried
+        up to MOLYUU_REPO_FETCH_RETRIES times. Segments of a large file resume from whichever mirror is tried next.
+        A mirror that failed is moved to the end of the list so the following downloads try it last.
+
+        Parameters:
+            filename: A string representing the name of the file in the repository.
+            path: A string representing the path to save the downloaded file.
+            kwargs: The arguments passed to download_file().
+
+        Raises:
+            Exception: If no mirror could serve the file.
+
+        Returns:
+            An optional string with the filename of the downloaded file, None if the local copy is up to date.
+        """
+        for attempt in range(0, FETCH_RETRIES + 1):
+            if attempt > 0:
+                print(f"Retrying {filename}...  [{attempt}/{FETCH_RETRIES}]")
+                time.sleep(2 ** attempt)
+
+            with self.mirrors_lock:
+                mirrors = list(self.mirrors)
+            for mirror in mirrors:
+                try:
+                    return self.download_file(f"{mirror}/{filename}", path, retries=0, **kwargs)
+                except Exception as e:
+                    print(f"Mirror {mirror} failed to serve {filename}: {e}")
+                    with self.mirrors_lock:
+                        if mirror in self.mirrors and len(self.mirrors) > 1:
+                            self.mirrors.remove(mirror)
+                            self.mirrors.append(mirror)
+
+        raise Exception(f"Failed to download {filename} from repo {self.name}")
+
+    def download_segments(self, url: str, partial_filename: str, size: int) -> Optional[str]:
+        """
+        Downloads a file as MOLYUU_REPO_SEGMENT_JOBS concurrent HTTP range requests.
+        Each segment is written to its own file next to `partial_filename`, so an interrupted download
+        resumes where its segments stopped, even from another mirror.
+
+        Parameters:
+            url: A string representing the URL of the file to be downloaded.
+            partial_filename: A string representing the path the segments are joined to.
+            size: The size of the file.
+
+        Raises:
+            requests.RequestException: If a segment failed to download.
+
+        Returns:
+            An optional string with the SHA256 digest of the joined file, None if the server does not support range requests.
+        """
+        segment_size = -(-size // SEGMENT_JOBS)
+        segments = [(f"{partial_filename}.{start // segment_size}", start, min(size, start + segment_size) - 1)
+                    for start in range(0, size, segment_size)]
+
+        def fetch(segment) -> bool:
+            segment_filename, start, end = segment
+            done = os.path.getsize(segment_filename) if os.path.exists(segment_filename) else 0
+            if done > end - start + 1:
+                os.remove(segment_filename)
+                done = 0
+            if done == end - start + 1:
+                return True
+
+            headers = {"Range": f"bytes={start + done}-{end}"}
+            with self.get_session(url).get(url, headers=headers, stream=True, timeout=60) as r:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    return False
+                with open(segment_filename, "ab") as f:
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+
+            if os.path.getsize(segment_filename) != end - start + 1:
+                raise requests.RequestException(f"Segment {segment_filename} of {url} is incomplete")
+            return True
+
+        with ThreadPoolExecutor(max_workers=segments.__len__()) as executor:
+            supported = all(list(executor.map(fetch, segments)))
+
+        if not supported:
+            for segment_filename, _, _ in segments:
+                if os.path.exists(segment_filename):
+                    os.remove(segment_filename)
+            return None
+
+        sha256 = hashlib.sha256()
+        with open(partial_filename, "wb") as f:
+            for segment_filename, _, _ in segments:
+                with open(segment_filename, "rb") as segment:
+                    while chunk := segment.read(DOWNLOAD_CHUNK_SIZE):
+                        sha256.update(chunk)
+                        f.write(chunk)
+                os.remove(segment_filename)
+        tracer.annotate(bytes=size, status=206)
+        return sha256.hexdigest()
+
+    @traced("download", "{url}")
+    def download_file(self, url, path, conditional: bool = False, sha256sum: Optional[str] = None,
+                      size: Optional[int] = None, retries: int = FETCH_RETRIES) -> Optional[str]:
+        """
+        A function to download a file from a given URL to a specified path.
+        Failed downloads are retried up to `retries` times.
+        Files of at least MOLYUU_REPO_SEGMENT_THRESHOLD bytes are downloaded in resumable segments, see download_segments().
+
+        Parameters:
+            self: instance of the class
+            url: A string representing the URL of the file to be downloaded.
+            path: A string representing the path to save the downloaded file.
+            conditional: Only download the file if it changed upstream since it was last downloaded to `path`.
+            sha256sum: The expected SHA256 digest of the file, verified while the file is written.
+            size: The expected size of the file, checked before the body is downloaded.
+            retries: How many times a failed download is retried.
+
+        Raises:
+            Exception: If the file could not be downloaded or does not match `sha256sum` or `size`.
+
+        Returns:
+            An optional string with the filename of the downloaded file, None if the local copy is up to date.
+        """
+        os.makedirs(f"{path}", exist_ok=True)
+
+        local_filename = url.split('/')[-1]
+        partial_filename = f"{path}/{local_filename}.part"
+        validators_filename = f"{path}/{local_filename}.validators.json"
+
+        # Validators of the previous download, used for HTTP conditional requests
+        headers = {}
+        validators = {}
+        if conditional and os.path.exists(f"{path}/{local_filename}") and os.path.exists(validators_filename):
+            with open(validators_filename, "r") as f:
+                validators = json.load(f)
+            if validators.get("url") == url:
+                if validators.get("etag") is not None:
+                    headers["If-None-Match"] = validators["etag"]
+                if validators.get("last_modified") is not None:
+                    headers["If-Modified-Since"] = validators["last_modified"]
+
+        for attempt in range(0, retries + 1):
+            if attempt > 0:
+                print(f"Retrying {url}...  [{attempt}/{retries}]")
+                time.sleep(2 ** attempt)
+
+            if os.getenv("MOLYUU_REPO_FETCH_VIA_WGET") == "1":
+                ret = os.system(f"wget -q {url} -O {partial_filename}")
+                if ret == 0:
+                    digest = file_sha256(partial_filename) if sha256sum is not None else None
+                    break
+            else:
+                try:
+                    if size is not None and size >= SEGMENT_THRESHOLD and not conditional:
+                        digest = self.download_segments(url, partial_filename, size)
+                        if digest is not None:
+                            break
+
+                    sha256 = hashlib.sha256()
+                    with self.get_session(url).get(url, headers=headers, stream=True, timeout=60) as r:
+                        if len(headers) > 0 and r.status_code == 304:
+                            return None
+                        r.raise_for_status()
+                        content_length = r.headers.get("Content-Length")
+                        if size is not None and content_length is not None and int(content_length) != size:
+                            raise Exception(f"Size mismatch for {url}: expected {size}, got {content_length}")
+                        # Hash while writing so the file does not need to be read back for verification
+                        with open(partial_filename, 'wb') as f:
+                            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                                sha256.update(chunk)
+                                f.write(chunk)
+                        tracer.annotate(bytes=os.path.getsize(partial_filename), status=r.status_code)
+                        digest = sha256.hexdigest()
+                        validators = {
+                            "url": url,
+                            "etag": r.headers.get("ETag"),
+                            "last_modified": r.headers.get("Last-Modified")
+                        }
+                    break
+                except requests.RequestException as e:
+                    print(f"Failed to download {url}: {e}")
+        else:
+            if os.path.exists(partial_filename):
+                os.remove(partial_filename)
+            raise Exception(f"Failed to download {url}")
+
+        if sha256sum is not None and digest != sha256sum:
+            os.remove(partial_filename)
+            for segment_filename in glob.glob(f"{glob.escape(partial_filename)}.*"):
+                os.remove(segment_filename)
+            raise Exception(f"Failed to verify {url}: expected {sha256sum}, got {digest}")
+
+        os.replace(partial_filename, f"{path}/{local_filename}")
+        if conditional:
+            with open(validators_filename, "w") as f:
+                json.dump(validators, f)
+        return local_filename
+
+    @traced("repository", "refresh_database {self.name}")
+    def refresh_database(self):
+        """
+        Refreshes the database by fetching and parsing the database file.
+        The database is kept in a persistent folder and only downloaded again when it changed upstream,
+        in which case the packages are loaded from the index parsed on a previous run.
+        """
+        database_folder = f"{CACHE_DIR}/database"
+        database_filename = self.DATABASE_FILENAME.format(name=self.name)
+        index_filename = f"{database_folder}/{self.name}.index.json"
+
+        # Fetch Database
+        downloaded = self.download_from_mirrors(database_filename, database_folder, conditional=True)
+        database = self.get_database_stamp(f"{database_folder}/{database_filename}")
+
+        # The index is only trusted if it was parsed from the database file that is on disk now,
+        # a run interrupted between the download and the parse leaves an index of the previous database behind
+        if downloaded is None and os.path.exists(index_filename):
+            with open(index_filename, "r") as f:
+                index = json.load(f)
+            if (index.get("format") == self.INDEX_FORMAT and index.get("url") == self.url
+                    and index.get("database") == database):
+                self.packages = index["packages"]
+                return
+
+        # Parse Database
+        self.packages = self.parse_database(f"{database_folder}/{database_filename}")
+
+        with open(f"{index_filename}.tmp", "w") as f:
+            json.dump({"format": self.INDEX_FORMAT, "url": self.url, "database": database, "packages": self.packages},
+                      f, separators=(",", ":"))
+        os.replace(f"{index_filename}.tmp", index_filename)
+
+    @staticmethod
+    def get_database_stamp(path: str) -> dict:
+        """
+        Identifies the content of a downloaded database file without reading it.
+
+        Parameters:
+            path: A string representing the path to the database file.
+
+        Returns:
+            A dictionary with the size and modification time of the file and the validators it was downloaded with.
+        """
+        st = os.stat(path)
+        validators = {}
+        if os.path.exists(f"{path}.validators.json"):
+            with open(f"{path}.validators.json", "r") as f:
+                validators = json.load(f)
+        return {
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "etag": validators.get("etag"),
+            "last_modified": validators.get("last_modified")
+        }
+
+    @staticmethod
+    def parse_database(path: str) -> dict:
+        """
+        Parses the packages of a sync database.
+
+        Parameters:
+            path: A string representing the path to the database file.
+
+        Returns:
+            A dictionary mapping package names to their parsed `desc` entries, see parse_desc().
+        """
+        packages = {}
+        # Stream the archive once instead of seeking back through it for each entry
+        with open_decompressed(path) as f, tarfile.open(fileobj=f, mode='r|') as tar:
+            for member in tar:
+                if member.isfile() and member.name.endswith("/desc"):
+                    package = parse_desc(tar.extractfile(member).read().decode("utf-8"))
+                    packages[package["name"]] = package
+                # Drop the members already seen so memory stays bounded on large databases
+                tar.members = []
+
+        return packages
+
+    def find_package(self, name) -> Optional[dict]:
+        """
+        Find a package based on the provided name.
+
+        Parameters:
+            name: A string representing the name of the package to find.
+
+        Returns:
+            An optional dictionary with the package information if found, otherwise None.
+        """
+        if name not in self.packages:
+            return None
+
+        return self.packages.get(name)
+
+    def download_from_stores(self, package_info: dict, stores: list) -> bool:
+        """
+        Downloads a package from the first of the given published repositories that serves it to the package cache.
+        Published packages carry sanitized filenames, see sanitize_package_filename().
+
+        Parameters:
+            package_info: The package information, as returned by find_package().
+            stores: A list of the URLs of the published repositories.
+
+        Returns:
+            bool: True if a store served the package with the expected checksum.
+        """
+        package_cache = f"{CACHE_DIR}/packages"
+        published_filename = package_info["filename"].replace(":", ".")
+        for store in stores:
+            try:
+                self.download_file(f"{store}/{published_filename}", package_cache,
+                                   sha256sum=package_info["sha256sum"],
+                                   size=int(package_info["csize"]) if "csize" in package_info else None, retries=0)
+            except Exception as e:
+                print(f"Store {store} failed to serve {published_filename}: {e}")
+                continue
+            os.replace(f"{package_cache}/{published_filename}", f"{package_cache}/{package_info['filename']}")
+            return True
+        return False
+
+    @traced("fetch", "{name}")
+    def fetch_package(self, name, path, stores: Optional[list] = None, debug: bool = True) -> Optional[Tuple[str, str]]:
+        """
+        Fetches a package based on the provided name and path.
+
+        Parameters:
+            name: A string representing the name of the package to fetch.
+            path: A string representing the path to save the fetched package.
+            stores: Additional folders or URLs holding previously published packages to reuse before downloading
+                    from the mirrors.
+            debug: Also fetch the `{name}-debug` package if the repository has one.
+
+        Returns:
+            An optional tuple with filenames of fetched packages if successful, otherwise None.
+        """
+        package_info = self.find_package(name)
+        package_debug_info = self.find_package(f"{name}-debug") if debug else None
+
+        if package_info is None:
+            return None
+
+        os.makedirs(f"{path}", exist_ok=True)
+        package_cache = f"{CACHE_DIR}/packages"
+
+        for pkg in [package_info, package_debug_info]:
+            if pkg is None:
+                continue
+
+            # Reuse a cached or stored copy with the expected checksum before touching the network
+            cached = f"{package_cache}/{pkg['filename']}"
+            candidates = [cached] + [f"{store}/{filename}" for store in stores or [] if "://" not in store
+                                     for filename in [pkg["filename"], pkg["filename"].replace(":", ".")]]
+            for candidate in candidates:
+                if os.path.exists(candidate) and file_sha256(candidate) == pkg["sha256sum"]:
+                    if candidate != cached:
+                        os.makedirs(package_cache, exist_ok=True)
+                        link_or_copy(candidate, cached)
+                    break
+            else:
+                if not self.download_from_stores(pkg, [store for store in stores or [] if "://" in store]):
+                    self.download_from_mirrors(pkg["filename"], package_cache,
+                                               sha256sum=pkg["sha256sum"],
+                                               size=int(pkg["csize"]) if "csize" in pkg else None)
+
+            link_or_copy(cached, f"{path}/{pkg['filename']}")
+
+        return (package_info["filename"], package_debug_info["filename"] if package_debug_info is not None else None)
+
+
+class PublishedRepository(Repository):
+    DATABASE_FILENAME = "{name}.db"
+
+    def __init__(self, location: str):
+        """
+        Loads the database of the repository we published last, to compare fetched packages against it.
+
+        Parameters:
+            location: A string with the local path or the URL of the published `{name}.db`.
+        """
+        self.location = location
+        super().__init__(os.path.basename(location)[:-len(".db")], os.path.dirname(location))
+
+    def refresh_database(self):
+        """
+        Refreshes the database from the URL of the published repository, or parses it from its local path.
+        """
+        if "://" in self.location:
+            super().refresh_database()
+        else:
+            self.packages = self.parse_database(self.location)
+
+    def is_unchanged(self, package: dict) -> bool:
+        """
+        Checks whether a package of an upstream database is the one we already published.
+
+        Parameters:
+            package: The upstream package information, as returned by Repository.find_package().
+
+        Returns:
+            bool: True if the published package has the same version and checksum.
+        """
+        published = self.find_package(package["name"])
+        return (published is not None and published.get("version") == package.get("version")
+                and published.get("sha256sum") == package.get("sha256sum"))
+
+
+class SrcInfo:
+    def __init__(self, text: str):
+        self.text = text
+        self.pkgbase = {}
+        self.packages = {}
+        self.parse()
+
+    def parse(self):
+        """
+        Parses the .SRCINFO text into the fields of the pkgbase section and of each package section.
+        Every field maps to a list of values, architecture specific fields keep their suffix such as `depends_x86_64`.
+        """
+        section = None
+        for line in self.text.split("\n"):
+            match = re.match(r"^\s*(\w+) = ?(.*)$", line)
+            if match is None:
+                continue
+
+            key, value = match.group(1), match.group(2).strip()
+            if key == "pkgbase":
+                section = self.pkgbase
+            elif key == "pkgname":
+                section = self.packages.setdefault(value, {})
+            if section is None:
+                continue
+
+            # An empty value in a package section clears the inherited pkgbase value
+            values = section.setdefault(key, [])
+            if value != "":
+                values.append(value)
+
+    def get(self, field: str, pkgname: Optional[str] = None, arch: str = CARCH) -> list:
+        """
+        Returns the values of a field including its architecture specific variant.
+
+        Parameters:
+            field: A string with the field name, such as `depends`.
+            pkgname: The package to read the field of, package sections override pkgbase. None reads pkgbase.
+            arch: The architecture whose specific field is appended.
+
+        Returns:
+            list: The values of the field.
+        """
+        package = self.packages.get(pkgname, {}) if pkgname is not None else {}
+        values = []
+        for key in [field, f"{field}_{arch}"]:
+            values += package[key] if key in package else self.pkgbase.get(key, [])
+        return values
+
+    def get_pkgnames(self) -> list:
+        """
+        Returns the names of the packages built by this PKGBUILD.
+        """
+        return list(self.packages.keys())
+
+    def get_build_depends(self, arch: str = CARCH) -> list:
+        """
+        Returns the pkgbase depends, makedepends and checkdepends, which makepkg needs installed to build.
+        """
+        return self.get("depends", arch=arch) + self.get("makedepends", arch=arch) + self.get("checkdepends", arch=arch)
+
+    def get_all_depends(self, arch: str = CARCH) -> list:
+        """
+        Returns the build dependencies together with the runtime dependencies of every split package.
+        """
+        depends = self.get_build_depends(arch)
+        for pkgname in self.get_pkgnames():
+            depends += [dep for dep in self.get("depends", pkgname, arch) if dep not in depends]
+        return depends
+
+
+class SyncIndex:
+    def __init__(self, path: str):
+        self.path = path
+        self.packages = {}
+        self.provides = {}
+        self.load()
+
+    @staticmethod
+    def get_repo_order() -> Optional[list]:
+        """
+        Returns the repositories configured in pacman.conf, in the order pacman searches them.
+
+        Returns:
+            An optional list with the names of the repositories, None if pacman-conf is not available.
+        """
+        try:
+            output = subprocess.check_output(["pacman-conf", "--repo-list"], text=True, stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        return [repo for repo in output.split("\n") if repo != ""]
+
+    def load(self):
+        """
+        Loads the sync databases of the repositories configured in pacman.conf from the sync database folder of pacman.
+        Packages of a database loaded earlier take precedence, like repositories listed first in pacman.conf.
+        Without pacman-conf, every database of the folder is loaded in alphabetical order instead.
+        """
+        if not os.path.exists(self.path):
+            return
+
+        repos = self.get_repo_order()
+        if repos is None:
+            repos = sorted(filename[:-len(".db")] for filename in os.listdir(self.path) if filename.endswith(".db"))
+
+        for repo in repos:
+            if not os.path.exists(f"{self.path}/{repo}.db"):
+                continue
+
+            for name, package in Repository.parse_database(f"{self.path}/{repo}.db").items():
+                if name in self.packages:
+                    continue
+                self.packages[name] = package
+                for provided in package.get("provides", []):
+                    provided_name, _, provided_version = parse_dependency(provided)
+                    self.provides.setdefault(provided_name, []).append((name, provided_version))
+
+    def find_satisfier(self, dep: str) -> Optional[dict]:
+        """
+        Finds a package satisfying the given dependency, either by name or through its provides.
+
+        Parameters:
+            dep: A dependency string, optionally with a version constraint such as `foo>=1.0`.
+
+        Returns:
+            An optional dictionary with the information of the satisfying package, None if no package satisfies `dep`.
+        """
+        name, operator, version = parse_dependency(dep)
+
+        def satisfies(candidate_version):
+            if operator is None:
+                return True
+            # An unversioned provide never satisfies a versioned dependency
+            if candidate_version is None:
+                return False
+            ret = vercmp(candidate_version, version)
+            return {"<": ret < 0, "<=": ret <= 0, "=": ret == 0, ">=": ret >= 0, ">": ret > 0}[operator]
+
+        package = self.packages.get(name)
+        if package is not None and satisfies(package["version"]):
+            return package
+
+        for provider, provided_version in self.provides.get(name, []):
+            if satisfies(provided_version):
+                return self.packages[provider]
+
+        return None
+
+    def resolve_versions(self, deps: list) -> dict:
+        """
+        Resolves the versions the sync databases would provide for the given dependencies.
+
+        Parameters:
+            deps: A list of dependency strings.
+
+        Returns:
+            A dictionary mapping dependencies to `name=version` of the satisfying package,
+            dependencies no sync database satisfies map to None.
+        """
+        versions = {}
+        for dep in deps:
+            package = self.find_satisfier(dep)
+            versions[dep] = f"{package['name']}={package['version']}" if package is not None else None
+        return versions
+
+
+class AurResolver:
+    # Packages queried per RPC request, keeps the request URL well below server limits
+    BATCH_SIZE = 100
+
+    def __init__(self, url: str, cache_path: str, sync_index: SyncIndex):
+        self.url = url
+        self.cache_path = cache_path
+        self.sync_index = sync_index
+        self.lock = threading.Lock()
+        # Package name -> {"time": query time, "result": RPC result or None if the package does not exist}
+        self.cache = {}
+        if os.path.exists(cache_path):
+            with open(cache_path, "r") as f:
+                self.cache = json.load(f)
+
+    def query(self, names: list, max_age: int = AUR_CACHE_TTL) -> dict:
+        """
+        Queries the AUR RPC interface for the given packages, using batched requests for packages not cached yet.
+
+        Parameters:
+            names: A list of package names.
+            max_age: How many seconds a cached result stays valid.
+
+        Returns:
+            A dictionary mapping each name to its RPC result, or None if the package does not exist on the AUR.
+        """
+        with self.lock:
+            now = time.time()
+            missing = sorted(set(name for name in names
+                                 if name not in self.cache or now - self.cache[name]["time"] > max_age))
+
+            for batch_idx in range(0, missing.__len__(), self.BATCH_SIZE):
+                batch = missing[batch_idx:batch_idx + self.BATCH_SIZE]
+                url = f"{self.url}/rpc/?v=5&type=info"
+                r = Repository.get_session(url).get(url, params={"arg[]": batch}, timeout=60)
+                r.raise_for_status()
+                results = {result["Name"]: result for result in r.json()["results"]}
+                for name in batch:
+                    self.cache[name] = {"time": now, "result": results.get(name)}
+
+            if missing.__len__() > 0:
+                os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+                with open(f"{self.cache_path}.tmp", "w") as f:
+                    json.dump(self.cache, f)
+                os.replace(f"{self.cache_path}.tmp", self.cache_path)
+
+            return {name: self.cache[name]["result"] for name in names}
+
+    @staticmethod
+    def find_missing(deps) -> set:
+        """
+        Returns the dependencies not satisfied by the installed packages.
+        """
+        if len(deps) == 0:
+            return set()
+        ret = subprocess.run(["pacman", "-T"] + sorted(deps), capture_output=True, text=True)
+        return set(ret.stdout.split("\n")) & set(deps)
+
+    def resolve_versions(self, deps: list) -> dict:
+        """
+        Resolves the versions of the AUR packages the given dependencies would be built from,
+        including their own dependencies that the sync databases do not satisfy.
+        Unlike resolve(), packages that are already installed are resolved as well.
+
+        Parameters:
+            deps: A list of dependency strings.
+
+        Returns:
+            A dictionary mapping the names of the AUR packages to `name=version`,
+            names not available on the AUR map to None.
+        """
+        versions = {}
+        level = set(strip_version_constraint(dep) for dep in deps)
+        while len(level) > 0:
+            unresolved = set()
+            for name, result in self.query(sorted(level)).items():
+                versions[name] = f"{result['Name']}={result['Version']}" if result is not None else None
+                if result is None:
+                    continue
+                for dep in result.get("Depends", []) + result.get("MakeDepends", []) + result.get("CheckDepends", []):
+                    if self.sync_index.find_satisfier(dep) is None:
+                        unresolved.add(strip_version_constraint(dep))
+            level = unresolved - set(versions.keys())
+        return versions
+
+    def resolve(self, deps: list) -> list:
+        """
+        Resolves the AUR packages needed to satisfy the given dependencies, including their own dependencies
+        that neither the sync databases nor the installed packages satisfy.
+
+        Parameters:
+            deps: A list of dependency strings to resolve from the AUR.
+
+        Raises:
+            Exception: If a dependency does not exist on the AUR.
+
+        Returns:
+            list: The RPC results of the packages to build, deduplicated by package base and ordered so that
+                  every package comes after the AUR packages it depends on.
+        """
+        deps = sorted(self.find_missing(deps))
+        results = {}
+        requires = {}
+        level = set(strip_version_constraint(dep) for dep in deps)
+        while len(level) > 0:
+            for name, result in self.query(sorted(level)).items():
+                if result is None:
+                    raise Exception(f"Failed to resolve dependency: {name} is not available on the AUR.")
+                results[name] = result
+
+            # Collect the dependencies of this level that still need to come from the AUR
+            unresolved = set()
+            for name in level:
+                result = results[name]
+                requires[name] = set()
+                for dep in result.get("Depends", []) + result.get("MakeDepends", []) + result.get("CheckDepends", []):
+                    if self.sync_index.find_satisfier(dep) is None:
+                        requires[name].add(strip_version_constraint(dep))
+                        unresolved.add(dep)
+
+            missing = self.find_missing(unresolved)
+            installed = set(strip_version_constraint(dep) for dep in unresolved if dep not in missing)
+
+            for name in level:
+                requires[name] -= installed
+            level = set().union(*[requires[name] for name in level]) - set(results.keys())
+
+        # Depth-first post-order so dependencies are built first
+        plan = []
+        bases = set()
+        visited = set()
+
+        def visit(name):
+            if name in visited:
+                return
+            visited.add(name)
+            for dependency in sorted(requires[name]):
+                visit(dependency)
+            if results[name]["PackageBase"] not in bases:
+                bases.add(results[name]["PackageBase"])
+                plan.append(results[name])
+
+        for dep in deps:
+            visit(strip_version_constraint(dep))
+
+        return plan
+
+
+class GitMirrorCache:
+    def __init__(self, path: str):
+        self.path = path
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    def get_mirror_path(self, url: str) -> str:
+        """
+        Returns the path of the bare mirror of the given repository URL.
+        """
+        name = re.sub(r"[^A-Za-z0-9._-]+", "_", url.split("://")[-1]).strip("_")
+        return os.path.abspath(f"{self.path}/{name}-{hashlib.sha256(url.encode('utf-8')).hexdigest()[:12]}.git")
+
+    def update(self, url: str) -> str:
+        """
+        Creates or incrementally fetches the bare mirror of the given repository URL.
+
+        Parameters:
+            url: A string representing the URL of the git repository.
+
+        Raises:
+            Exception: If the repository could not be fetched.
+
+        Returns:
+            A string with the path of the mirror.
+        """
+        mirror = self.get_mirror_path(url)
+        with self.locks_lock:
+            lock = self.locks.setdefault(mirror, threading.Lock())
+
+        with lock:
+            if os.path.exists(mirror):
+                ret = os.system(f"git -C {mirror} fetch --quiet --prune origin")
+            else:
+                os.makedirs(self.path, exist_ok=True)
+                if os.path.exists(f"{mirror}.tmp"):
+                    shutil.rmtree(f"{mirror}.tmp")
+                ret = os.system(f"git clone --quiet --mirror {url} {mirror}.tmp")
+                if ret == 0:
+                    os.rename(f"{mirror}.tmp", mirror)
+
+        if ret != 0:
+            raise Exception(f"Failed to fetch {url}.")
+        return mirror
+
+    def checkout(self, url: str, dest: str, recursive: bool = False):
+        """
+        Checks out the given repository URL to `dest`, borrowing the objects of its mirror so no history is
+        transferred again. The checkout's origin still points to `url`.
+        An existing checkout of the same URL is updated in place, its untracked files are discarded to the trash.
+
+        Parameters:
+            url: A string representing the URL of the git repository.
+            dest: A string representing the path to check the repository out to.
+            recursive: Also check out the submodules of the repository, through their own mirrors.
+
+        Raises:
+            Exception: If the repository could not be fetched or checked out.
+        """
+        mirror = self.update(url)
+        origin = None
+        if os.path.isdir(f"{dest}/.git"):
+            origin = subprocess.run(["git", "-C", dest, "remote", "get-url", "origin"],
+                                    capture_output=True, text=True).stdout.strip()
+
+        if origin == url:
+            untracked = subprocess.run(["git", "-C", dest, "ls-files", "-z", "--others", "--directory"],
+                                       capture_output=True, text=True).stdout
+            for path in untracked.split("\0"):
+                if path != "":
+                    trash.discard(f"{dest}/{path.rstrip('/')}")
+            ret = os.system(f"git -C {dest} fetch --quiet {mirror} HEAD && git -C {dest} reset --quiet --hard FETCH_HEAD")
+        else:
+            if os.path.lexists(dest):
+                trash.discard(dest)
+            ret = os.system(f"git clone --quiet --shared {mirror} {dest} && git -C {dest} remote set-url origin {url}")
+        if ret != 0:
+            raise Exception(f"Failed to check out {url}.")
+
+        if recursive:
+            self.checkout_submodules(dest)
+
+    def checkout_submodules(self, dest: str):
+        """
+        Checks out the submodules of the repository at `dest` recursively, fetching their mirrors concurrently.
+        """
+        if not os.path.exists(f"{dest}/.gitmodules"):
+            return
+
+        # submodule init resolves relative submodule URLs against origin
+        ret = os.system(f"git -C {dest} submodule --quiet init")
+        if ret != 0:
+            raise Exception(f"Failed to check out submodules of {dest}.")
+
+        output = subprocess.run(["git", "-C", dest, "config", "--get-regexp", r"^submodule\..*\.url$"],
+                                capture_output=True, text=True).stdout
+        submodules = {}
+        for line in output.splitlines():
+            key, url = line.split(" ", 1)
+            submodules[key[len("submodule."):-len(".url")]] = url
+
+        with ThreadPoolExecutor(max_workers=FETCH_JOBS) as executor:
+            mirrors = dict(zip(submodules.keys(), executor.map(self.update, submodules.values())))
+
+        for name, url in submodules.items():
+            path = subprocess.check_output(["git", "-C", dest, "config", "-f", ".gitmodules",
+                                            f"submodule.{name}.path"], text=True).strip()
+            # Check out from the mirror, then point the submodule back to its upstream
+            ret = os.system(f"git -C {dest} config submodule.{name}.url {mirrors[name]}"
+                            f" && git -C {dest} -c protocol.file.allow=always submodule --quiet update -- {path}"
+                            f" && git -C {dest} config submodule.{name}.url {url}"
+                            f" && git -C {dest}/{path} remote set-url origin {url}")
+            if ret != 0:
+                raise Exception(f"Failed to check out submodule {name} of {dest}.")
+            self.checkout_submodules(f"{dest}/{path}")
+
+
+class BuildCache:
+    # Sources fetched from version control can change without the PKGBUILD changing
+    VCS_SOURCE = re.compile(r"(^|::)(git|svn|hg|bzr|fossil)\+")
+    # Left in a PKGBUILD folder by makepkg, git and previous builds, not part of the inputs of a build
+    BUILD_LEFTOVER_FOLDERS = ["src", "pkg", ".git"]
+    BUILD_LEFTOVER_FILES = ["*.pkg.tar.*", "*.log"]
+
+    def __init__(self, path: str, sync_index: SyncIndex, aur_resolver: Optional["AurResolver"] = None):
+        self.path = path
+        self.sync_index = sync_index
+        self.aur_resolver = aur_resolver
+        self.lock = threading.Lock()
+        self.used_entries = set()
+
+    @classmethod
+    def get_input_files(cls, pkgbuild_dir: str) -> list:
+        """
+        Lists the files of a PKGBUILD folder that go into a build, skipping the leftovers of previous builds.
+
+        Parameters:
+            pkgbuild_dir: A string representing the path to the directory containing the PKGBUILD file.
+
+        Returns:
+            list: The sorted paths of the files, relative to `pkgbuild_dir`.
+        """
+        files = []
+        for root, dirs, filenames in os.walk(pkgbuild_dir):
+            relative = os.path.relpath(root, pkgbuild_dir)
+            if relative == ".":
+                dirs[:] = [folder for folder in dirs if folder not in cls.BUILD_LEFTOVER_FOLDERS]
+                relative = ""
+            else:
+                relative += "/"
+            files += [f"{relative}{filename}" for filename in filenames if not (relative == "" and (
+                      any(fnmatch.fnmatch(filename, pattern) for pattern in cls.BUILD_LEFTOVER_FILES)))]
+            # Symlinked folders are hashed as links, not followed
+            for folder in list(dirs):
+                if os.path.islink(f"{root}/{folder}"):
+                    dirs.remove(folder)
+                    files.append(f"{relative}{folder}")
+        return sorted(files)
+
+    def compute_key(self, pkgbuild_dir: str, built: Optional[dict] = None) -> Optional[str]:
+        """
+        Computes the cache key of the package located in the given `pkgbuild_dir`.
+        The key covers its .SRCINFO, every file of the PKGBUILD folder and the resolved dependency versions.
+        Dependencies are resolved from the packages built in the same run first, then from the sync databases,
+        then from the AUR, so a dependency rebuilt at a new version invalidates the packages built against it.
+
+        Parameters:
+            pkgbuild_dir: A string representing the path to the directory containing the PKGBUILD file.
+            built: A dictionary mapping the names provided by the packages built in this run to a string
+                   identifying their build, see PackageGetter.build_target().
+
+        Returns:
+            An optional string with the cache key, None if the package can not be cached.
+        """
+        srcinfo = load_srcinfo(pkgbuild_dir)
+        sources = srcinfo.get("source")
+        if any(self.VCS_SOURCE.search(source) for source in sources):
+            return None
+
+        sha256 = hashlib.sha256()
+        sha256.update(srcinfo.text.encode("utf-8"))
+
+        # Local sources may be listed with SKIP checksums and install or changelog files are not listed
+        # as sources at all, hash every file of the folder except the leftovers of previous builds
+        for filename in self.get_input_files(pkgbuild_dir):
+            path = f"{pkgbuild_dir}/{filename}"
+            sha256.update(filename.encode("utf-8") + b"\0")
+            if os.path.islink(path):
+                sha256.update(os.readlink(path).encode("utf-8"))
+            else:
+                sha256.update(bytes.fromhex(file_sha256(path)))
+
+        built = built or {}
+        depends = srcinfo.get_all_depends()
+        versions = self.sync_index.resolve_versions([dep for dep in depends
+                                                     if strip_version_constraint(dep) not in built])
+        for dep in depends:
+            if strip_version_constraint(dep) in built:
+                versions[dep] = f"built:{built[strip_version_constraint(dep)]}"
+
+        missing = [dep for dep, version in versions.items() if version is None]
+        if self.aur_resolver is not None and len(missing) > 0:
+            for name, version in self.aur_resolver.resolve_versions(missing).items():
+                versions[f"aur:{name}"] = version
+
+        for name, version in sorted(versions.items()):
+            sha256.update(f"{name}={version}\n".encode("utf-8"))
+
+        return sha256.hexdigest()
+
+    def restore(self, key: str, dest: str) -> Optional[list]:
+        """
+        Links the packages cached under `key` to the `dest` directory, copying them across filesystems.
+
+        Returns:
+            An optional list with the filenames of the restored packages, None if `key` is not cached.
+        """
+        entry = f"{self.path}/{key}"
+        with self.lock:
+            self.used_entries.add(key)
+        if not os.path.isdir(entry):
+            return None
+
+        packages = sorted(os.listdir(entry))
+        if len(packages) == 0:
+            return None
+
+        for package in packages:
+            link_or_copy(f"{entry}/{package}", f"{dest}/{package}")
+        return packages
+
+    def store(self, key: str, src: str, packages: list):
+        """
+        Stores the given packages from the `src` directory under `key`.
+        """
+        entry = f"{self.path}/{key}"
+        with self.lock:
+            self.used_entries.add(key)
+        staging = f"{entry}.tmp"
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+
+        for package in packages:
+            shutil.copy2(f"{src}/{package}", f"{staging}/{package}")
+
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.rename(staging, entry)
 
-        return result if result.__len__() > 0 else None
 
-    def get_build_list(self, src_source: str) -> Optional[list]:
+    def prune(self):
         """
-        A function that retrieves the build list based on the src_source parameter.
+        Removes the cached builds that were not restored or stored during this run, such as the builds
+        against dependency versions that were bumped since.
+        """
+        if not os.path.exists(self.path):
+            return
+        for entry in os.listdir(self.path):
+            if entry not in self.used_entries:
+                shutil.rmtree(f"{self.path}/{entry}")
+
+
+class MakepkgCache:
+    # Sources fetched from version control, makepkg names their folder in SRCDEST after the repository
+    VCS_SOURCE = re.compile(r"^(git|svn|hg|bzr|fossil)\+")
+    CCACHE_WRAPPERS = "/usr/lib/ccache/bin"
+
+    def __init__(self, srcdest: str, ccache: str):
+        self.srcdest = os.path.abspath(srcdest)
+        self.ccache = os.path.abspath(ccache)
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        # Entries of SRCDEST used during this run, never evicted by prune()
+        self.used = set()
+
+    @classmethod
+    def get_source_filename(cls, source: str) -> Optional[str]:
+        """
+        Returns the name makepkg stores a source entry under in SRCDEST, like makepkg's get_filename does.
 
         Parameters:
-            self: instance of the Manifest class
-            src_source: a string representing the source to retrieve the build list from
+            source: A string with a `source` entry of a .SRCINFO, such as `name::https://host/file.tar.xz`.
 
         Returns:
-            An optional list of build items associated with the src_source if found, otherwise None.
+            The name of the file or folder in SRCDEST, None for files shipped next to the PKGBUILD.
         """
-        if src_source not in self.build:
+        name, sep, url = source.partition("::")
+        if sep != "":
+            return name
+        if "://" not in source:
             return None
-        return list(self.build.get(src_source))
 
+        filename = source.split("#")[0].rstrip("/").split("/")[-1]
+        if cls.VCS_SOURCE.match(source):
+            filename = filename.split("?")[0]
+            if source.startswith("git+") and ".git" in filename:
+                filename = filename[:filename.index(".git")]
+        return filename
 
-class Repository:
-    def __init__(self, name: str, url: str):
-        self.name = name
-        self.url = url.replace('$repo', name)
-        self.packages = {}
-        self.refresh_database()
+    def get_environment(self, stats_log: str) -> dict:
+        """
+        Returns the environment variables pointing makepkg to the managed SRCDEST and ccache folders.
 
-    def download_file(self, url, path):
+        Parameters:
+            stats_log: A string with the path ccache logs the result of every compilation to.
         """
-        A function to download a file from a given URL to a specified path.
+        env = {
+            "SRCDEST": self.srcdest,
+            "CCACHE_DIR": self.ccache,
+            "CCACHE_MAXSIZE": CCACHE_MAX_SIZE,
+            "CCACHE_STATSLOG": stats_log
+        }
+        if os.path.isdir(self.CCACHE_WRAPPERS):
+            env["PATH"] = f"{self.CCACHE_WRAPPERS}:$PATH"
+        return env
+
+    def run(self, pkgbuild_dir: str, args: str) -> int:
+        """
+        Runs makepkg with the managed SRCDEST and ccache folders and reports their hits and misses.
+        The sources are downloaded first while holding a lock on each of their SRCDEST entries,
+        so concurrent builds sharing a source do not download it over each other.
 
         Parameters:
-            self: instance of the class
-            url: A string representing the URL of the file to be downloaded.
-            path: A string representing the path to save the downloaded file.
+            pkgbuild_dir: A string representing the path to the directory containing the PKGBUILD file.
+            args: A string with the arguments passed to makepkg.
 
         Returns:
-            A string with the filename of the downloaded file.
+            int: The exit status of makepkg.
         """
-        if not os.path.exists(f"{path}"):
-            os.mkdir(f"{path}")
-
-        local_filename = url.split('/')[-1]
-        # NOTE the stream=True parameter below
-        if os.getenv("MOLYUU_REPO_FETCH_VIA_WGET") == "1":
-            ret = os.system(f"wget {url} -O {path}/{local_filename}")
+        srcinfo = load_srcinfo(pkgbuild_dir)
+        filenames = sorted(set(filename for filename in map(self.get_source_filename, srcinfo.get("source"))
+                               if filename is not None))
+        stats_log = os.path.abspath(f"{pkgbuild_dir}/ccache-stats.log")
+        env = self.get_environment(stats_log)
+
+        with self.locks_lock:
+            locks = [self.locks.setdefault(filename, threading.Lock()) for filename in filenames]
+            self.used.update(filenames)
+
+        source_hits = 0
+        with contextlib.ExitStack() as stack:
+            for lock in locks:
+                stack.enter_context(lock)
+            source_hits = sum(1 for filename in filenames if os.path.exists(f"{self.srcdest}/{filename}"))
+            os.makedirs(self.srcdest, exist_ok=True)
+            ret = run_makepkg(pkgbuild_dir, "--verifysource --nodeps --noconfirm", env)
             if ret != 0:
-                raise Exception(f"Failed to download {url}")
-        else:
-            with requests.get(url, stream=True) as r:
-                r.raise_for_status()
-                with open(f"{path}/{local_filename}", 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        # If you have chunk encoded response uncomment if
-                        # and set chunk_size parameter to None.
-                        # if chunk:
-                        f.write(chunk)
-        return local_filename
+                return ret
+
+        if os.path.exists(stats_log):
+            os.remove(stats_log)
+        ret = run_makepkg(pkgbuild_dir, f"--holdver {args}", env)
+
+        # Entries are evicted least recently used first, see prune()
+        for filename in filenames:
+            if os.path.exists(f"{self.srcdest}/{filename}"):
+                os.utime(f"{self.srcdest}/{filename}")
+
+        ccache_hits = 0
+        ccache_misses = 0
+        if os.path.exists(stats_log):
+            with open(stats_log, "r") as f:
+                for line in f:
+                    ccache_hits += 1 if line.strip().endswith("cache_hit") else 0
+                    ccache_misses += 1 if line.strip() == "cache_miss" else 0
+
+        print(f"Cache stats of {pkgbuild_dir}: sources {source_hits} hit / {len(filenames) - source_hits} miss, "
+              f"ccache {ccache_hits} hit / {ccache_misses} miss")
+        tracer.annotate(source_hits=source_hits, source_misses=len(filenames) - source_hits,
+                        ccache_hits=ccache_hits, ccache_misses=ccache_misses)
+        return ret
+
+    def prune(self):
+        """
+        Evicts the least recently used SRCDEST entries not used during this run until SRCDEST fits MOLYUU_REPO_SRCDEST_MAX_SIZE.
+        ccache evicts its own least recently used entries to stay below MOLYUU_REPO_CCACHE_MAX_SIZE.
+        """
+        if not os.path.exists(self.srcdest):
+            return
 
-    def refresh_database(self):
+        entries = []
+        total = 0
+        for filename in os.listdir(self.srcdest):
+            path = f"{self.srcdest}/{filename}"
+            size = os.lstat(path).st_size
+            if os.path.isdir(path) and not os.path.islink(path):
+                for root, dirs, files in os.walk(path):
+                    size += sum(os.lstat(f"{root}/{name}").st_size for name in dirs + files)
+            entries.append((os.lstat(path).st_mtime, filename, size))
+            total += size
+
+        for _, filename, size in sorted(entries):
+            if total <= SRCDEST_MAX_SIZE:
+                break
+            if filename in self.used:
+                continue
+            print(f"Evicting {filename} from SRCDEST")
+            path = f"{self.srcdest}/{filename}"
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            total -= size
+
+
+class Signer:
+    def __init__(self, password: str, cache_path: str):
+        self.password = password
+        # Signatures are only reused if they were made with this key, see verify()
+        self.fingerprint = self.get_fingerprint()
+        # Detached signatures made with this key, keyed by package digest. Both bind a cached signature
+        # to the key and the package content, so it is reused without spawning gpg to verify it.
+        self.cache_root = cache_path
+        self.cache_path = f"{cache_path}/{self.fingerprint}"
+        self.executor = ThreadPoolExecutor(max_workers=SIGN_JOBS)
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.used_signatures = set()
+
+    def submit(self, path: str):
         """
-        Refreshes the database by fetching and parsing the database file. No parameters or return types specified.
+        Starts signing the package at the given path in the background, unless it was already submitted.
         """
-        database_folder = "workspace/repos/database"
-        # Fetch Database
-        self.download_file(
-            f"{self.url}/{self.name}.db.tar.xz", database_folder)
+        with self.lock:
+            if path not in self.futures:
+                self.futures[path] = self.executor.submit(self.sign, path)
 
-        # Parse Database
-        with tarfile.open(f"{database_folder}/{self.name}.db.tar.xz", 'r:xz') as tar:
-            root_files = [member for member in tar.getmembers(
-            ) if member.isdir() and member.name.count('/') == 0]
-            folders = [member.name for member in root_files]
-            for folder in folders:
-                desc = tar.extractfile(f"{folder}/desc")
-                desc_content = desc.read().decode("utf-8")
-
-                package_name = re.search(
-                    r'%NAME%\n(.+)\n', desc_content).group(1)
-                package_file = re.search(
-                    r'%FILENAME%\n(.+)\n', desc_content).group(1)
-                package_sha256sum = re.search(
-                    r'%SHA256SUM%\n(.+)\n', desc_content).group(1)
-                self.packages[package_name] = {
-                    "filename": package_file,
-                    "sha256sum": package_sha256sum
-                }
+    def wait(self, paths: list):
+        """
+        Signs every package of the given list that was not submitted yet and waits until all submitted packages are signed.
 
-    def find_package(self, name) -> Optional[dict]:
+        Raises:
+            Exception: If a package failed to sign.
         """
-        Find a package based on the provided name.
+        for path in paths:
+            self.submit(path)
 
-        Parameters:
-            name: A string representing the name of the package to find.
+        with self.lock:
+            futures = dict(self.futures)
+        for path, future in futures.items():
+            if future.exception() is not None:
+                raise Exception(f"Package {path} failed to sign: {future.exception()}")
 
-        Returns:
-            An optional dictionary with the package information if found, otherwise None.
+    @staticmethod
+    def get_fingerprint() -> str:
         """
-        if name not in self.packages:
-            return None
+        Returns the fingerprint of the primary key packages are signed with, the first secret key of the keyring.
 
-        return self.packages.get(name)
+        Raises:
+            Exception: If the keyring holds no secret key.
+        """
+        output = subprocess.run(["gpg", "--batch", "--with-colons", "--list-secret-keys"],
+                                capture_output=True, text=True).stdout
+        records = [line.split(":") for line in output.split("\n")]
+        for record_idx, record in enumerate(records):
+            # The fingerprint record follows the record of its key
+            if record[0] == "sec" and record_idx + 1 < records.__len__() and records[record_idx + 1][0] == "fpr":
+                return records[record_idx + 1][9]
+        raise Exception("No secret key to sign packages with.")
+
+    def verify(self, path: str, signature: str) -> bool:
+        """
+        Checks whether `signature` is a valid detached signature of the file at `path` made with our signing key.
+        A signature that is valid for another key of the keyring, such as a rotated key, does not count.
+        """
+        ret = subprocess.run(["gpg", "--batch", "--quiet", "--status-fd", "1", "--verify", signature, path],
+                             capture_output=True, text=True)
+        if ret.returncode != 0:
+            return False
+        for line in ret.stdout.split("\n"):
+            fields = line.split()
+            # VALIDSIG carries the fingerprint of the signing subkey first and of its primary key last
+            if fields[:2] == ["[GNUPG:]", "VALIDSIG"] and self.fingerprint in [fields[2], fields[-1]]:
+                return True
+        return False
+
+    def prune(self):
+        """
+        Removes the cached signatures of other keys and of packages that were not signed during this run.
+        """
+        if not os.path.exists(self.cache_root):
+            return
+        for entry in os.listdir(self.cache_root):
+            if entry != self.fingerprint:
+                remove_path(f"{self.cache_root}/{entry}")
+        if not os.path.exists(self.cache_path):
+            return
+        for filename in os.listdir(self.cache_path):
+            if filename not in self.used_signatures:
+                os.remove(f"{self.cache_path}/{filename}")
 
-    def fetch_package(self, name, path) -> Optional[Tuple[str, str]]:
+    @traced("sign", "{path}")
+    def sign(self, path: str, cache: bool = True):
         """
-        Fetches a package based on the provided name and path.
+        Signs the file at the given path, reusing its current signature when still valid or a signature cached
+        for the same content and key.
 
         Parameters:
-            name: A string representing the name of the package to fetch.
-            path: A string representing the path to save the fetched package.
+            path: A string representing the path of the file to sign.
+            cache: Keep the signature in the signature cache.
 
-        Returns:
-            An optional tuple with filenames of fetched packages if successful, otherwise None.
+        Raises:
+            Exception: If the file failed to sign.
         """
-        package_info = self.find_package(name)
-        package_debug_info = self.find_package(f"{name}-debug")
+        signature = f"{path}.sig"
+        if os.path.exists(signature) and self.verify(path, signature):
+            return
+        if not cache:
+            return self.sign_file(path)
+
+        digest = file_sha256(path)
+        with self.lock:
+            self.used_signatures.add(f"{digest}.sig")
+        cached = f"{self.cache_path}/{digest}.sig"
+        if os.path.exists(cached):
+            shutil.copy2(cached, signature)
+            return
 
-        if package_info is None:
-            return None
+        self.sign_file(path)
+        os.makedirs(self.cache_path, exist_ok=True)
+        shutil.copy2(signature, cached)
+
+    def sign_file(self, path: str):
+        """
+        Creates the detached signature `{path}.sig` with gpg.
 
-        if not os.path.exists(f"{path}"):
-            os.mkdir(f"{path}")
+        Raises:
+            Exception: If the file failed to sign.
+        """
+        ret = subprocess.run(["gpg", "--batch", "--yes", "--detach-sign", "--pinentry-mode", "loopback",
+                              "--local-user", self.fingerprint, "--passphrase", self.password, "--output", f"{path}.sig", "--sign", path]).returncode
+        tracer.annotate(exit_code=ret)
+        if ret != 0:
+            raise Exception(f"Failed to sign {path}.")
 
-        # Download Package
-        self.download_file(f"{self.url}/{package_info['filename']}", path)
 
-        if package_debug_info is not None:
-            self.download_file(
-                f"{self.url}/{package_debug_info['filename']}", path)
+class DatabaseWriter:
+    # .PKGINFO keys and the `desc` fields they are written to, in the order repo-add writes them
+    PKGINFO_FIELDS = [
+        ("pkgname", "NAME"), ("pkgbase", "BASE"), ("pkgver", "VERSION"), ("pkgdesc", "DESC"),
+        ("group", "GROUPS"), ("csize", "CSIZE"), ("size", "ISIZE"), ("md5sum", "MD5SUM"),
+        ("sha256sum", "SHA256SUM"), ("pgpsig", "PGPSIG"), ("url", "URL"), ("license", "LICENSE"),
+        ("arch", "ARCH"), ("builddate", "BUILDDATE"), ("packager", "PACKAGER"), ("replaces", "REPLACES"),
+        ("conflict", "CONFLICTS"), ("provides", "PROVIDES"), ("depend", "DEPENDS"), ("optdepend", "OPTDEPENDS"),
+        ("makedepend", "MAKEDEPENDS"), ("checkdepend", "CHECKDEPENDS")
+    ]
 
-        # Verify Package
-        for pkg in [package_info, package_debug_info]:
-            if pkg is None:
-                continue
+    def __init__(self, name: str, path: str, cache_path: str, digests: Optional[dict] = None):
+        """
+        Parameters:
+            name: A string representing the name of the repository.
+            path: A string representing the path of the repository folder.
+            cache_path: A string representing the path of the entry cache.
+            digests: A dictionary mapping filenames to the SHA256 digests already verified while fetching them.
+        """
+        self.name = name
+        self.path = path
+        # Parsed entries of previously read packages, keyed by package digest
+        self.cache_path = cache_path
+        self.digests = digests or {}
+        # Filename -> stat stamp and digest of the packages read by the previous write
+        self.stamps_path = f"{cache_path}/stamps.json"
+        self.stamps = {}
+
+    @staticmethod
+    def get_stamp(path: str) -> list:
+        """
+        Returns the size, modification time and inode of a file, which change whenever the file is replaced.
+        """
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
 
-            with open(f"{path}/{pkg['filename']}", 'rb') as file:
-                sha256 = hashlib.sha256()
-                while chunk := file.read(1024):
-                    sha256.update(chunk)
+    def read_package(self, filename: str) -> dict:
+        """
+        Reads the metadata and the file list of a package, from the entry cache when the package was read before.
+        The entry is looked up by the digest verified while fetching the package, or by the digest read
+        by the previous write if the file was not replaced since, so cached packages are not read at all.
 
-                if sha256.hexdigest() != pkg["sha256sum"]:
-                    print(f"Package {name} failed verification.")
-                    os.remove(f"{path}/{pkg['filename']}")
-                    return None
+        Parameters:
+            filename: A string with the filename of the package in the repository folder.
 
-        return (package_info["filename"], package_debug_info["filename"] if package_debug_info is not None else None)
+        Returns:
+            dict: The package with its .PKGINFO values (lists keyed by .PKGINFO key) and its `files`.
+        """
+        path = f"{self.path}/{filename}"
+        stamp = self.get_stamp(path)
+        digest = self.digests.get(filename)
+        if digest is None and self.stamps.get(filename, {}).get("stamp") == stamp:
+            digest = self.stamps[filename]["sha256sum"]
+        if digest is not None and os.path.exists(f"{self.cache_path}/{digest}.json"):
+            with open(f"{self.cache_path}/{digest}.json", "r") as f:
+                return json.load(f)
+
+        package = {"files": []}
+        with open_decompressed(path) as f, tarfile.open(fileobj=f, mode="r|") as tar:
+            for member in tar:
+                if member.name == ".PKGINFO":
+                    for line in tar.extractfile(member).read().decode("utf-8").split("\n"):
+                        key, sep, value = line.partition(" = ")
+                        if sep != "" and not key.startswith("#"):
+                            package.setdefault(key.strip(), []).append(value.strip())
+                elif not member.name.startswith("."):
+                    package["files"].append(member.name + ("/" if member.isdir() else ""))
+                # Only the headers are needed, drop them so memory stays bounded on large packages
+                tar.members = []
+
+        package["files"].sort()
+        sha256 = hashlib.sha256()
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            while chunk := f.read(DOWNLOAD_CHUNK_SIZE):
+                sha256.update(chunk)
+                md5.update(chunk)
+        package["sha256sum"] = [sha256.hexdigest()]
+        package["md5sum"] = [md5.hexdigest()]
+
+        cached = f"{self.cache_path}/{package['sha256sum'][0]}.json"
+        os.makedirs(self.cache_path, exist_ok=True)
+        with open(f"{cached}.{threading.get_ident()}", "w") as f:
+            json.dump(package, f)
+        os.replace(f"{cached}.{threading.get_ident()}", cached)
+        return package
+
+    def render_desc(self, filename: str, package: dict) -> str:
+        """
+        Renders the `desc` entry of a package.
+        """
+        package = dict(package)
+        package["csize"] = [str(os.path.getsize(f"{self.path}/{filename}"))]
+        if os.path.exists(f"{self.path}/{filename}.sig"):
+            with open(f"{self.path}/{filename}.sig", "rb") as f:
+                package["pgpsig"] = [base64.b64encode(f.read()).decode("ascii")]
+
+        desc = f"%FILENAME%\n{filename}\n\n"
+        for key, field in self.PKGINFO_FIELDS:
+            if len(package.get(key, [])) > 0:
+                desc += f"%{field}%\n" + "\n".join(package[key]) + "\n\n"
+        return desc
+
+    @traced("repository", "write {self.name}.db")
+    def write(self) -> bool:
+        """
+        Writes `{name}.db` and `{name}.files` for every package in the repository folder.
+        Packages are read in parallel, and older versions of a package are removed like `repo-add -R` does.
+
+        Returns:
+            bool: True if the databases were written successfully.
+        """
+        filenames = sorted(os.path.basename(path) for path in glob.glob(f"{self.path}/*.pkg.tar.zst"))
+        if os.path.exists(self.stamps_path):
+            with open(self.stamps_path, "r") as f:
+                self.stamps = json.load(f)
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+            packages = dict(zip(filenames, executor.map(self.read_package, filenames)))
+
+        # Drop cached entries of packages no longer in the repository
+        used_entries = set(f"{package['sha256sum'][0]}.json" for package in packages.values())
+        for entry in os.listdir(self.cache_path) if os.path.exists(self.cache_path) else []:
+            if entry not in used_entries and entry != os.path.basename(self.stamps_path):
+                os.remove(f"{self.cache_path}/{entry}")
+
+        os.makedirs(self.cache_path, exist_ok=True)
+        with open(f"{self.stamps_path}.tmp", "w") as f:
+            json.dump({filename: {"stamp": self.get_stamp(f"{self.path}/{filename}"),
+                                  "sha256sum": package["sha256sum"][0]}
+                       for filename, package in packages.items()}, f)
+        os.replace(f"{self.stamps_path}.tmp", self.stamps_path)
+
+        # Keep only the newest version of every package
+        newest = {}
+        for filename, package in packages.items():
+            pkgname = package["pkgname"][0]
+            if pkgname in newest and vercmp(packages[newest[pkgname]]["pkgver"][0], package["pkgver"][0]) >= 0:
+                stale = filename
+            else:
+                stale = newest.get(pkgname)
+                newest[pkgname] = filename
+            if stale is not None:
+                print(f"Removing old package file {stale}")
+                for path in [f"{self.path}/{stale}", f"{self.path}/{stale}.sig"]:
+                    if os.path.exists(path):
+                        os.remove(path)
+
+        for database, with_files in [("db", False), ("files", True)]:
+            with tarfile.open(f"{self.path}/{self.name}.{database}.tmp", "w:xz") as tar:
+                for pkgname, filename in sorted(newest.items()):
+                    package = packages[filename]
+                    folder = f"{pkgname}-{package['pkgver'][0]}"
+                    entries = [("desc", self.render_desc(filename, package))]
+                    if with_files:
+                        entries.append(("files", "%FILES%\n" + "".join(f"{path}\n" for path in package["files"])))
+
+                    info = tarfile.TarInfo(folder)
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0o755
+                    tar.addfile(info)
+                    for entry, content in entries:
+                        data = content.encode("utf-8")
+                        info = tarfile.TarInfo(f"{folder}/{entry}")
+                        info.size = len(data)
+                        info.mode = 0o644
+                        tar.addfile(info, io.BytesIO(data))
+            os.replace(f"{self.path}/{self.name}.{database}.tmp", f"{self.path}/{self.name}.{database}")
+
+        return True
+
+
+def sanitize_package_filename(path: str) -> str:
+    """
+    Renames a package whose filename contains special characters, such as the `:` of an epoch.
+
+    Returns:
+        A string with the new path of the package.
+    """
+    sanitized = os.path.join(os.path.dirname(path), os.path.basename(path).replace(":", "."))
+    if sanitized != path:
+        os.replace(path, sanitized)
+    return sanitized
 
 
 class PackageGetter:
-    def __init__(self, manifest: Manifest):
+    def __init__(self, manifest: Manifest, signer: Optional[Signer] = None):
         self.repos = {}
         self.manifest = manifest
-        self.pacman_known_packages = subprocess.check_output("pacman -Slq", shell=True).decode("utf-8").split("\n")[:-1]
+        self.signer = signer
+        self.sync_index = SyncIndex(PACMAN_SYNC_DIR)
+        self.git_mirrors = GitMirrorCache(f"{CACHE_DIR}/git")
+        self.aur_resolver = AurResolver(AUR_URL, f"{CACHE_DIR}/aur/info.json", self.sync_index)
+        self.build_cache = BuildCache(f"{CACHE_DIR}/build", self.sync_index, self.aur_resolver)
+        self.makepkg_cache = MakepkgCache(f"{CACHE_DIR}/srcdest", f"{CACHE_DIR}/ccache")
+        # pacman holds a database lock, so concurrent builds take turns installing dependencies
+        self.pacman_lock = threading.RLock()
+        # Installation of the sync database dependencies of the whole run, while builds are scheduled
+        self.run_build_deps = None
+        # Debug packages fetched in the background, see fetch_packages_from_repos()
+        self.debug_executor = None
+        self.debug_futures = {}
+        # Published filename -> SHA256 digest of the fetched packages, verified while fetching them
+        self.digests = {}
         self.init_repos()
 
     def init_repos(self) -> bool:
@@ -242,100 +2263,178 @@ class PackageGetter:
         """
         Fetches packages from repositories based on the manifest.
 
+        Packages are fetched concurrently by MOLYUU_REPO_FETCH_JOBS workers. Debug packages are fetched along
+        with their package, not at all, or in the background depending on the `fetch_debug` mode of the manifest.
+        Background downloads run one at a time once every other package was fetched, see wait_debug_packages().
+
         Returns:
             bool: True if all packages were fetched successfully, False otherwise.
         """
+        # Debug packages of a previous call would download to the same files
+        self.wait_debug_packages()
+
+        jobs = []
         for name, repo in self.repos.items():
-            print("Fetching packages from repo " + name)
             package_list = self.manifest.get_packages(name)
 
             if package_list is None:
                 continue
 
-            for package_idx in range(0, package_list.__len__()):
-                package = package_list[package_idx]
-                print(
-                    f"Fetching {package}...  [{package_idx + 1}/{package_list.__len__()}]")
-                if repo.fetch_package(package, f"workspace/output") is None:
+            print(f"Fetching {package_list.__len__()} packages from repo {name}")
+            jobs += [(repo, package) for package in package_list]
+
+        # Delta mode: packages unchanged since our last publish are reused from the artifact store,
+        # which defaults to the folder or URL the published database is served from
+        stores = {}
+        published = None
+        if PUBLISHED_DB != "":
+            try:
+                published = PublishedRepository(PUBLISHED_DB)
+            except Exception as e:
+                print(f"Failed to load published database {PUBLISHED_DB}, fetching every package: {e}")
+
+        if published is not None:
+            for repo, package in jobs:
+                package_info = repo.find_package(package)
+                if package_info is not None and published.is_unchanged(package_info):
+                    stores[package] = [ARTIFACT_STORE or os.path.dirname(PUBLISHED_DB)]
+            print(f"{stores.__len__()} of {jobs.__len__()} packages are unchanged since the last publish")
+
+        debug = self.manifest.fetch_debug == "on"
+        with ThreadPoolExecutor(max_workers=FETCH_JOBS) as executor:
+            futures = {executor.submit(repo.fetch_package, package, "workspace/output", stores.get(package), debug): package
+                       for repo, package in jobs}
+            fetched = set()
+            for job_idx, future in enumerate(as_completed(futures)):
+                package = futures[future]
+                if future.exception() is not None or future.result() is None:
+                    # Do not start the remaining downloads once one package failed
+                    for pending in futures:
+                        pending.cancel()
+                    if future.exception() is not None:
+                        raise future.exception()
                     raise Exception(f"Package {package} not found!")
+                fetched.update(filename for filename in future.result() if filename is not None)
+                self.publish_packages([filename for filename in future.result() if filename is not None])
+                print(f"Fetched {package}  [{job_idx + 1}/{jobs.__len__()}]")
+
+        debug_jobs = []
+        if self.manifest.fetch_debug == "background":
+            for repo, package in jobs:
+                package_debug_info = repo.find_package(f"{package}-debug")
+                if package_debug_info is not None:
+                    debug_jobs.append((repo, f"{package}-debug", stores.get(package)))
+                    fetched.add(package_debug_info["filename"])
+
+        # Every fetched package was verified against the database digest, the repository database reuses them
+        for repo, package in jobs:
+            for package_info in [repo.find_package(package), repo.find_package(f"{package}-debug")]:
+                if package_info is not None:
+                    self.digests[package_info["filename"].replace(":", ".")] = package_info["sha256sum"]
+
+        # Drop cached packages that are no longer part of the repository
+        package_cache = f"{CACHE_DIR}/packages"
+        for filename in os.listdir(package_cache) if os.path.exists(package_cache) else []:
+            if filename not in fetched:
+                os.remove(f"{package_cache}/{filename}")
+
+        if debug_jobs.__len__() > 0:
+            print(f"Fetching {debug_jobs.__len__()} debug packages in the background")
+            self.debug_executor = ThreadPoolExecutor(max_workers=1)
+            self.debug_futures = {self.debug_executor.submit(self.fetch_debug_package, repo, package, package_stores): package
+                                  for repo, package, package_stores in debug_jobs}
+
+        return True
 
-    def fetch_aur_packages_src(self) -> bool:
+    def fetch_debug_package(self, repo: Repository, package: str, stores: Optional[list]):
         """
-        Fetches AUR packages source code based on the build list from the manifest.
+        Fetches a debug package in the background and starts signing it.
 
-        Returns:
-            bool: True if all AUR packages were fetched successfully, False otherwise.
+        Parameters:
+            repo: The repository of the debug package.
+            package: The name of the debug package.
+            stores: Additional folders or URLs holding previously published packages to reuse before downloading
+                    from the mirrors.
         """
-        package_list = self.manifest.get_build_list("aur")
-        if package_list is None:
-            return False
+        filename, _ = repo.fetch_package(package, "workspace/output", stores, False)
+        self.publish_packages([filename])
+        print(f"Fetched {package} in the background")
 
-        for package_idx in range(0, package_list.__len__()):
-            package = package_list[package_idx]
-            print(
-                f"Fetching {package}...  [{package_idx + 1}/{package_list.__len__()}]")
-            ret = os.system(
-                f"git clone https://aur.archlinux.org/{package}.git workspace/build/{package}")
-            if ret != 0:
-                print(f"Package {package} failed to fetch.")
-                raise Exception(f"Package {package} failed to fetch.")
+    def wait_debug_packages(self):
+        """
+        Waits until the debug packages fetched in the background landed in the output folder.
 
-        return True
+        Raises:
+            Exception: If a debug package failed to fetch.
+        """
+        if self.debug_executor is None:
+            return
 
-    def fetch_remote_packages_src(self) -> bool:
+        self.debug_executor.shutdown(wait=True)
+        self.debug_executor = None
+        for future, package in self.debug_futures.items():
+            if future.exception() is not None:
+                print(f"Package {package} failed to fetch: {future.exception()}")
+                raise Exception(f"Package {package} failed to fetch.")
+
+    def get_build_sources(self) -> list:
         """
-        Fetches remote packages source code based on the build list from the manifest.
+        Lists the sources of every package to build from the manifest, remote packages first, then local and AUR packages.
 
         Returns:
-            bool: True if all remote packages were fetched successfully, False otherwise.
+            list: A list of dictionaries with the `package` folder name, the git `url` to check out (None for local packages)
+                  and the `targets`, a list of (name, PKGBUILD folder) tuples of the packages built from the source.
         """
-        package_list = self.manifest.get_build_list("remote")
-        if package_list is None:
-            return False
-
-        for package_idx in range(0, package_list.__len__()):
-            package_def = package_list[package_idx]
+        sources = []
+        for package_def in self.manifest.get_build_list("remote") or []:
             remote_url = package_def["url"]
-
             package = os.path.basename(remote_url).replace(".git", "")
             if package == '':
                 package = os.path.basename(remote_url[:-1]).replace(".git", "")
                 if package == '':
                     raise Exception(f"Invalid package URL: {remote_url}")
 
-            print(
-                f"Fetching {package}...  [{package_idx + 1}/{package_list.__len__()}]")
-            ret = os.system(
-                f"git clone {remote_url} workspace/build/{package}")
-            if ret != 0:
-                print(f"Package {package} failed to fetch.")
-                raise Exception(f"Package {package} failed to fetch.")
+            subpkgs = [os.path.dirname(pkgbuild) for pkgbuild in package_def["PKGBUILDs"]]
+            sources.append({"package": package, "url": remote_url,
+                            "targets": [(f"{package}::{subpkg}", f"workspace/build/{package}/{subpkg}") for subpkg in subpkgs]})
 
-        return True
+        for package in self.manifest.get_build_list("local") or []:
+            sources.append({"package": package, "url": None, "targets": [(package, f"workspace/build/{package}")]})
+
+        for package in self.manifest.get_build_list("aur") or []:
+            sources.append({"package": package, "url": f"{AUR_URL}/{package}.git",
+                            "targets": [(package, f"workspace/build/{package}")]})
 
-    def prepare_local_src(self) -> bool:
+        return sources
+
+    @traced("source", "{source[package]}")
+    def fetch_build_source(self, source: dict) -> list:
         """
-        Prepares local source packages for building.
-        Retrieves the list of local packages to build from the manifest, then copies each package to the build workspace directory.
+        Checks out a source to the build workspace through the git mirror cache, or syncs a local package to it,
+        then reads the .SRCINFO of every package built from it. Sources staged by a previous run are updated in place.
+
+        Parameters:
+            source (dict): The source to fetch, as returned by get_build_sources().
+
+        Raises:
+            Exception: If the source failed to fetch.
 
         Returns:
-            bool: True if all local packages were prepared successfully, False otherwise.
+            list: The build targets of the source, see read_build_target().
         """
-        package_list = self.manifest.get_build_list("local")
-        if package_list is None:
-            return False
-
-        for package_idx in range(0, package_list.__len__()):
-            package = package_list[package_idx]
-            print(
-                f"Preparing {package}...  [{package_idx + 1}/{package_list.__len__()}]")
-            ret = os.system(f"cp -r local/{package} workspace/build/{package}")
-            if ret != 0:
-                print(f"Package {package} failed to prepare.")
-                raise Exception(f"Package {package} failed to prepare.")
+        dest = f"workspace/build/{source['package']}"
+        if source["url"] is None:
+            if not os.path.isdir(f"local/{source['package']}"):
+                raise Exception(f"Package {source['package']} failed to prepare.")
+            if os.path.isdir(f"{dest}/.git"):
+                trash.discard(dest)
+            sync_tree(f"local/{source['package']}", dest)
+        else:
+            self.git_mirrors.checkout(source["url"], dest)
 
-        return True
+        return [self.read_build_target(name, pkgbuild_dir) for name, pkgbuild_dir in source["targets"]]
 
+    @traced("dependencies", "{pkgbuild_dir}")
     def install_build_deps(self, pkgbuild_dir: str, top: bool = True):
         """
         Install the dependencies for a package located in the given `pkgbuild_dir`.
@@ -348,19 +2447,16 @@ class PackageGetter:
             Exception: If the dependencies for the package could not be installed.
 
         Returns:
-            None
+            list: The filenames of the aur dependencies copied to the output folder.
         """
-        srcinfo = subprocess.check_output(f"cd {pkgbuild_dir} && makepkg --printsrcinfo", shell=True, text=True)
-        pkgbase = srcinfo.replace("\t", "").split("\n\n")[0]
-        depends = re.findall(r"^\s*depends = (.+)\n", pkgbase, re.MULTILINE)
-        makedepends = re.findall(r"^\s*makedepends = (.+)\n", pkgbase, re.MULTILINE)
-        checkdepends = re.findall(r"^\s*checkdepends = (.+)\n", pkgbase, re.MULTILINE)
+        srcinfo = load_srcinfo(pkgbuild_dir)
+        depends = srcinfo.get("depends")
 
         unresolved_deps = None        
         
         try:
             all_deps = []
-            for dep in depends + makedepends + checkdepends:
+            for dep in srcinfo.get_build_depends():
                 if re.search(r"(\w+)(?=[><=].*)", dep) == None:
                     all_deps.append(dep)
                 else:
@@ -375,12 +2471,13 @@ class PackageGetter:
 
         pacman_deps = []
         aur_deps = []
+        moved_packages = []
 
         if unresolved_deps != None:
             for dep in unresolved_deps:
                 if dep == '':
                     continue
-                if dep in self.pacman_known_packages:
+                if self.sync_index.find_satisfier(dep) is not None:
                     pacman_deps.append(dep)
                 else:
                     aur_deps.append(dep)
@@ -388,163 +2485,553 @@ class PackageGetter:
         # Install pacman dependencies
         if len(pacman_deps) > 0:
             print("Installing pacman build deps: " + " ".join(pacman_deps))
-            ret = os.system(f"sudo pacman -S --noconfirm " + " ".join(pacman_deps))
+            # Versioned dependencies such as foo>=1.0 must not reach a shell, which would treat them as redirects
+            ret = subprocess.run(["sudo", "pacman", "-S", "--noconfirm"] + pacman_deps).returncode
             if ret != 0:
                 raise Exception(f"Failed to install dependencies for {pkgbuild_dir}.")
             
-        # Install AUR dependencies
+        # Install AUR dependencies, the plan already orders them so their own AUR dependencies come first
         if len(aur_deps) > 0:
-            for dep in aur_deps:
-                result = json.loads(requests.get(f"https://aur.archlinux.org/rpc/?v=5&type=info&arg[]={dep}").content)
-                if result["resultcount"] == 0:
+            depends_names = set(strip_version_constraint(dep) for dep in depends)
+            for result in self.aur_resolver.resolve(aur_deps):
+                dep = result["PackageBase"]
+                if not os.path.exists(f"workspace/build/{dep}"):
+                    try:
+                        self.git_mirrors.checkout(f"{AUR_URL}/{dep}.git", f"workspace/build/{dep}")
+                    except Exception:
+                        raise Exception(f"Failed to install dependency: {dep} for {pkgbuild_dir}.")
+                self.install_build_deps(f"workspace/build/{dep}", False)
+                ret = self.makepkg_cache.run(f"workspace/build/{dep}", "-i --noconfirm")
+                if ret != 0:
                     raise Exception(f"Failed to install dependency: {dep} for {pkgbuild_dir}.")
-                else:
-                    matched = False
-                    for possible_match in result["results"]:
-                        if possible_match["Name"] == dep:
-                            matched = True
-                            ret = os.system(f"git clone https://aur.archlinux.org/{dep}.git workspace/build/{dep}")
-                            if ret != 0:
-                                raise Exception(f"Failed to install dependency: {dep} for {pkgbuild_dir}.")
-                            self.install_build_deps(f"workspace/build/{dep}", False)
-                            ret = os.system(f"cd workspace/build/{dep} && MAKEOPTS=\"-j$(nproc --all)\" makepkg -i --noconfirm")
-                            if ret != 0:
-                                raise Exception(f"Failed to install dependency: {dep} for {pkgbuild_dir}.")
-                            if (dep in depends) and (dep not in self.manifest.get_all_packages() and top):
-                                os.system(f"mv workspace/build/{dep}/*.pkg.tar.zst workspace/output/")
-                            break
+                if (result["Name"] in depends_names) and (result["Name"] not in self.manifest.get_all_packages() and top):
+                    moved_packages += move_packages(f"workspace/build/{dep}", "workspace/output")
 
-                    if not matched:
-                        raise Exception(f"Failed to install dependency: {dep} for {pkgbuild_dir}.")
-        
-    def build_packages(self) -> bool:
+        return moved_packages
+
+    @traced("dependencies", "install_repo_build_deps")
+    def install_repo_build_deps(self, deps: set):
         """
-        Builds and fetches packages from the local, remote, and AUR repositories based on the manifest.
+        Installs every dependency of the given set that the sync databases satisfy in a single pacman transaction,
+        so the builds themselves only have to install dependencies built from the AUR.
+
+        Parameters:
+            deps (set): The dependency strings of every package of the run.
+
+        Raises:
+            Exception: If the dependencies could not be installed.
         """
-        current_working_directory = os.getenv("PWD")
-        self.fetch_aur_packages_src()
-        self.fetch_remote_packages_src()
-        self.prepare_local_src()
-
-        if self.manifest.get_build_list("remote") is not None:
-            package_defs = self.manifest.get_build_list("remote")
-            for package_def_idx in range(0, package_defs.__len__()):
-                package_def = package_defs[package_def_idx]
-                remote_url = package_def["url"]
-                package = os.path.basename(remote_url).replace(".git", "")
-                if package == '':
-                    package = os.path.basename(remote_url[:-1]).replace(".git", "")
-                    if package == '':
-                        raise Exception(f"Invalid package URL: {remote_url}")
-                
-                pkgbuilds = package_def["PKGBUILDs"]
-                for pkgbuild in pkgbuilds:
-                    subpkg = os.path.dirname(pkgbuild)
-                    print(f"Building {package}::{subpkg}...  [{package_def_idx + 1}/{package_defs.__len__()}]")
-                    self.install_build_deps(f"workspace/build/{package}/{subpkg}")
-                    ret = os.system(f"cd workspace/build/{package}/{subpkg} && MAKEOPTS=\"-j$(nproc --all)\" makepkg --noconfirm")
-                    if ret != 0:
-                        print(f"Package {package}::{subpkg} failed to build.")
-                        raise Exception(f"Package {package}::{subpkg} failed to build.")
-
-                    os.system(f"mv workspace/build/{package}/{subpkg}/*.pkg.tar.zst workspace/output")
-
-        for src in ["local", "aur"]:
-            package_list = self.manifest.get_build_list(src)
-            if package_list is None:
-                continue
+        packages = set()
+        for dep in AurResolver.find_missing(deps):
+            package = self.sync_index.find_satisfier(dep)
+            if package is not None:
+                packages.add(package["name"])
+
+        if len(packages) == 0:
+            return
+
+        print("Installing pacman build deps: " + " ".join(sorted(packages)))
+        with self.pacman_lock:
+            ret = subprocess.run(["sudo", "pacman", "-S", "--needed", "--noconfirm"] + sorted(packages)).returncode
+        if ret != 0:
+            raise Exception("Failed to install build dependencies.")
+
+    @traced("build", "{package}")
+    def build_package(self, pkgbuild_dir: str, package: str, key: Optional[str] = None,
+                      installable: bool = False) -> list:
+        """
+        Builds the package located in the given `pkgbuild_dir` and moves the results to the output folder.
+        Packages whose cache key matches a previous build are restored from the build cache instead.
+
+        Parameters:
+            pkgbuild_dir (str): The path to the directory containing the package's PKGBUILD file.
+            package (str): The name of the package, used for reporting.
+            key (str): The cache key of the package, see BuildCache.compute_key(). None builds without the cache.
+            installable (bool): Packages built later install this package. A restored package then still gets
+                                its dependencies installed, such as the AUR packages it depends on at runtime.
+
+        Raises:
+            Exception: If the package failed to build.
+
+        Returns:
+            list: The filenames of the packages moved to the output folder.
+        """
+        if key is not None:
+            packages = self.build_cache.restore(key, "workspace/output")
+            if packages is not None:
+                print(f"Package {package} is unchanged, using cached build.")
+                if installable:
+                    self.install_package_deps(pkgbuild_dir, False)
+                return packages
+
+        packages = self.install_package_deps(pkgbuild_dir)
+
+        ret = self.makepkg_cache.run(pkgbuild_dir, "--noconfirm")
+        if ret != 0:
+            print(f"Package {package} failed to build.")
+            raise Exception(f"Package {package} failed to build.")
+
+        packages += move_packages(pkgbuild_dir, "workspace/output")
+        if key is not None:
+            self.build_cache.store(key, "workspace/output", packages)
+
+        return packages
+
+    def install_package_deps(self, pkgbuild_dir: str, top: bool = True) -> list:
+        """
+        Waits for the dependencies of the whole run, then installs the remaining dependencies of a package,
+        see install_build_deps().
+
+        Returns:
+            list: The filenames of the aur dependencies copied to the output folder.
+        """
+        # The dependencies of the whole run are installed first, see build_packages()
+        if self.run_build_deps is not None:
+            self.run_build_deps.result()
+
+        with self.pacman_lock:
+            return self.install_build_deps(pkgbuild_dir, top)
+
+    def read_build_target(self, name: str, pkgbuild_dir: str) -> dict:
+        """
+        Reads the .SRCINFO of a package to build.
+
+        Parameters:
+            name (str): The name of the package, used for reporting.
+            pkgbuild_dir (str): The path to the directory containing the package's PKGBUILD file.
+
+        Returns:
+            dict: A dictionary with the `name`, `dir`, `provides`, `depends` and `requires` of the package.
+                  `provides` maps every name the package provides to the package name providing it,
+                  `depends` holds the names of every dependency, including the runtime dependencies of split
+                  packages, for the build order, and `requires` the full strings of the dependencies makepkg needs
+                  installed to build it.
+        """
+        srcinfo = load_srcinfo(pkgbuild_dir)
+        provides = {}
+        for pkgname in srcinfo.get_pkgnames():
+            for provided in [pkgname] + srcinfo.get("provides", pkgname):
+                provides[strip_version_constraint(provided)] = pkgname
+
+        depends = srcinfo.get_all_depends()
+        return {
+            "name": name,
+            "dir": pkgbuild_dir,
+            "provides": provides,
+            "depends": set(strip_version_constraint(dep) for dep in depends),
+            "requires": set(srcinfo.get_build_depends())
+        }
+
+    def collect_build_targets(self) -> list:
+        """
+        Fetches the source of every package to build from the manifest and reads its .SRCINFO.
+        Sources are fetched concurrently by MOLYUU_REPO_FETCH_JOBS workers and each one is read as soon as it landed.
+
+        Raises:
+            Exception: If a source failed to fetch.
 
-            for package_idx in range(0, package_list.__len__()):
-                package = package_list[package_idx]
-                print(
-                    f"Building {package}...  [{package_idx + 1}/{package_list.__len__()}]")
+        Returns:
+            list: The build targets in manifest order, see read_build_target().
+        """
+        sources = self.get_build_sources()
+        packages = set(source["package"] for source in sources)
+        for entry in os.listdir("workspace/build"):
+            if entry not in packages:
+                trash.discard(f"workspace/build/{entry}")
+
+        targets = {}
+        with ThreadPoolExecutor(max_workers=FETCH_JOBS) as executor:
+            futures = {executor.submit(self.fetch_build_source, source): source_idx
+                       for source_idx, source in enumerate(sources)}
+            for done_idx, future in enumerate(as_completed(futures)):
+                package = sources[futures[future]]["package"]
+                if future.exception() is not None:
+                    for pending in futures:
+                        pending.cancel()
+                    print(f"Package {package} failed to fetch: {future.exception()}")
+                    raise Exception(f"Package {package} failed to fetch.")
+                targets[futures[future]] = future.result()
+                print(f"Fetched {package}  [{done_idx + 1}/{sources.__len__()}]")
+
+        return [target for source_idx in range(0, sources.__len__()) for target in targets[source_idx]]
+
+    def build_target(self, target: dict, dependencies: list) -> list:
+        """
+        Installs the packages built for the manifest packages `target` depends on, then builds `target`.
+        The cache key of `target` covers the builds of those dependencies, stored as the `key` of `target`.
 
-                self.install_build_deps(f"workspace/build/{package}")
-                ret = os.system(
-                    f"cd workspace/build/{package} && MAKEOPTS=\"-j$(nproc --all)\" makepkg --noconfirm")
+        Parameters:
+            target (dict): The package to build, as returned by read_build_target().
+            dependencies (list): The already built targets `target` depends on.
 
+        Returns:
+            list: The filenames of the packages moved to the output folder.
+        """
+        wanted = set()
+        # Dependencies without a cache key are identified by the versions of the packages they built
+        built = {}
+        for dependency in dependencies:
+            for provided, pkgname in dependency["provides"].items():
+                if provided in target["depends"]:
+                    wanted.add(pkgname)
+                    built[provided] = dependency["key"] or " ".join(sorted(dependency["packages"]))
+
+        files = []
+        for dependency in dependencies:
+            files += [f"workspace/output/{filename}" for filename in dependency["packages"]
+                      if package_name_from_filename(filename) in wanted]
+
+        if len(files) > 0:
+            with self.pacman_lock:
+                print(f"Installing built deps of {target['name']}: " + " ".join(files))
+                ret = os.system("sudo pacman -U --noconfirm " + " ".join(files))
                 if ret != 0:
-                    print(f"Package {package} failed to build.")
-                    raise Exception(f"Package {package} failed to build.")
+                    raise Exception(f"Failed to install dependencies for {target['name']}.")
+
+        target["key"] = self.build_cache.compute_key(target["dir"], built)
+        return self.publish_packages(self.build_package(target["dir"], target["name"], target["key"],
+                                                        target.get("installable", False)))
+
+    def publish_packages(self, packages: list) -> list:
+        """
+        Sanitizes the filenames of packages that landed in the output folder and starts signing them right away.
+
+        Parameters:
+            packages (list): The filenames of the packages in the output folder.
+
+        Returns:
+            list: The sanitized filenames of the packages.
+        """
+        published = []
+        for package in packages:
+            path = sanitize_package_filename(f"workspace/output/{package}")
+            if self.signer is not None:
+                self.signer.submit(path)
+            published.append(os.path.basename(path))
+        return published
+
+    def install_run_build_deps(self, targets: list):
+        """
+        Resolves the AUR dependencies of the whole run with batched RPC requests, then installs every dependency
+        of the run available from the sync databases in a single pacman transaction.
+
+        Parameters:
+            targets (list): The packages to build, as returned by collect_build_targets().
+        """
+        # Only build dependencies are resolved, the runtime dependencies of split packages are not needed to build
+        # and may come from repositories that are neither in the sync databases nor on the AUR
+        provided = set().union(*[target["provides"].keys() for target in targets])
+        aur_deps = set()
+        for target in targets:
+            aur_deps.update(strip_version_constraint(dep) for dep in target["requires"]
+                            if strip_version_constraint(dep) not in provided and self.sync_index.find_satisfier(dep) is None)
+        aur_plan = self.aur_resolver.resolve(sorted(aur_deps))
+
+        requires = set()
+        for target in targets:
+            requires.update(dep for dep in target["requires"] if strip_version_constraint(dep) not in provided)
+        for result in aur_plan:
+            requires.update(result.get("Depends", []) + result.get("MakeDepends", []) + result.get("CheckDepends", []))
+        # Builds compile through the ccache wrappers, see MakepkgCache
+        requires.add("ccache")
+        self.install_repo_build_deps(requires)
+
+    def build_packages(self, watch: Optional[list] = None) -> bool:
+        """
+        Builds and fetches packages from the local, remote, and AUR repositories based on the manifest.
+
+        The packages are ordered by the dependency graph read from their .SRCINFO, and packages that do not
+        depend on each other are built concurrently by MOLYUU_REPO_BUILD_JOBS workers.
+        Dependencies available from the sync databases are installed for the whole run in the background,
+        builds restored from the build cache go ahead meanwhile and the others wait for the install to finish.
+
+        Parameters:
+            watch (list): Futures of work running alongside the builds, no new build starts once one of them failed.
+        """
+        targets = self.collect_build_targets()
 
-                os.system(
-                    f"mv workspace/build/{package}/*.pkg.tar.zst workspace/output")
+        dependency_executor = ThreadPoolExecutor(max_workers=1)
+        self.run_build_deps = dependency_executor.submit(self.install_run_build_deps, targets)
+        try:
+            self.schedule_builds(targets, watch)
+        finally:
+            dependency_executor.shutdown(wait=True)
+            self.run_build_deps = None
+
+        self.makepkg_cache.prune()
+        self.build_cache.prune()
 
         return True
 
+    def schedule_builds(self, targets: list, watch: Optional[list] = None):
+        """
+        Builds the given targets in the order of their dependency graph, starting each one as soon as the targets
+        it depends on are built.
+
+        Parameters:
+            targets (list): The packages to build, as returned by collect_build_targets().
+            watch (list): Futures of work running alongside the builds. Once one of them fails, the builds already
+                          running finish and its exception is raised without starting the remaining builds.
 
-def build_repository(name: str, sign: bool = False, password: str = "") -> bool:
+        Raises:
+            Exception: If a package failed to build, a watched future failed or the packages depend on each other
+                       in a cycle.
+        """
+        watch = list(watch or [])
+        providers = {}
+        for target_idx, target in enumerate(targets):
+            for provided in target["provides"]:
+                providers.setdefault(provided, set()).add(target_idx)
+
+        # Edges of the dependency graph, in both directions
+        dependencies = []
+        dependents = [set() for _ in targets]
+        for target_idx, target in enumerate(targets):
+            target_deps = set()
+            for dep in target["depends"]:
+                target_deps.update(providers.get(dep, set()) - {target_idx})
+            dependencies.append(target_deps)
+            for dep_idx in target_deps:
+                dependents[dep_idx].add(target_idx)
+        for target_idx, target in enumerate(targets):
+            target["installable"] = len(dependents[target_idx]) > 0
+
+        pending = [set(target_deps) for target_deps in dependencies]
+        ready = [target_idx for target_idx in range(0, targets.__len__()) if len(pending[target_idx]) == 0]
+        started = 0
+
+        with ThreadPoolExecutor(max_workers=BUILD_JOBS) as executor:
+            running = {}
+            while len(ready) > 0 or len(running) > 0:
+                for target_idx in ready:
+                    started += 1
+                    print(f"Building {targets[target_idx]['name']}...  [{started}/{targets.__len__()}]")
+                    running[executor.submit(self.build_target, targets[target_idx],
+                                            [targets[dep_idx] for dep_idx in dependencies[target_idx]])] = target_idx
+                ready = []
+
+                done, _ = wait(list(running) + watch, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in watch:
+                        watch.remove(future)
+                        if future.exception() is not None:
+                            print(f"Not starting the remaining builds: {future.exception()}")
+                            raise future.exception()
+                        continue
+                    target_idx = running.pop(future)
+                    targets[target_idx]["packages"] = future.result()
+                    for dependent_idx in dependents[target_idx]:
+                        pending[dependent_idx].discard(target_idx)
+                        if len(pending[dependent_idx]) == 0:
+                            ready.append(dependent_idx)
+
+        if started != targets.__len__():
+            cycle = [target["name"] for target_idx, target in enumerate(targets) if len(pending[target_idx]) > 0]
+            raise Exception("Dependency cycle between packages: " + ", ".join(cycle))
+
+
+@traced("repository", "build_repository {name}")
+def build_repository(name: str, sign: bool = False, password: str = "", signer: Optional[Signer] = None,
+                     digests: Optional[dict] = None) -> bool:
     """
     A function to build a repository with the given name.
 
     Parameters:
         name: A string representing the name of the repository to build.
+        sign: Sign the packages and the repository database.
+        password: The passphrase of the signing key.
+        signer: The signer that already started signing packages as they landed in the output folder.
+        digests: The SHA256 digests of the fetched packages, see PackageGetter.digests.
 
     Returns:
         bool: True if the repository is built successfully, False otherwise.
     """
     # Rename package with special characters
-    ret = os.system(
-        f"cd workspace/output && for i in *:*.pkg.tar.zst; do mv $i $(echo $i | sed 's/:/./g'); done")
-    if ret != 0:
-        print(f"Repository {name} failed to build.")
+    packages = [sanitize_package_filename(package) for package in sorted(glob.glob("workspace/output/*.pkg.tar.zst"))]
+
+    if sign and password != "":
+        # Sign the packages not signed yet, their signatures are embedded in the database
+        if signer is None:
+            signer = Signer(password, f"{CACHE_DIR}/signatures")
+        signer.wait(packages)
+        signer.prune()
+
+    try:
+        DatabaseWriter(name, "workspace/output", f"{CACHE_DIR}/repo-db", digests).write()
+    except Exception as e:
+        print(f"Repository {name} failed to build: {e}")
         raise Exception(f"Repository {name} failed to build.")
-    
+
     if sign and password != "":
-        # Sign the repository
-        ret = os.system(f"""
-                        cd workspace/output
-                        for i in *.pkg.tar.zst; do
-                            gpg --batch --detach-sign --pinentry-mode loopback --passphrase {password} --output $i.sig --sign $i
-                        done
-                        repo-add --sign -n -R {name}.db.tar.xz *.pkg.tar.zst
-                        """)
-        if ret != 0:
-            print(f"Repository {name} failed to build.")
-            raise Exception(f"Repository {name} failed to build.")
-    else:
-        ret = os.system(
-            f"cd workspace/output && repo-add -n -R {name}.db.tar.xz *.pkg.tar.zst")
-        if ret != 0:
-            print(f"Repository {name} failed to build.")
-            raise Exception(f"Repository {name} failed to build.")
+        for database in ["db", "files"]:
+            signer.sign(f"workspace/output/{name}.{database}", cache=False)
+
+    return True
 
 
 def prepare_workspace():
-    if os.path.exists("workspace"):
+    """
+    Prepares the workspace folders. The build folder is kept so sources are staged incrementally,
+    the output of the previous run is discarded to the trash.
+    """
+    if os.path.exists("workspace/output"):
         print("Cleaning up workspace...")
-        os.system(f"rm -rf workspace")
 
-    os.mkdir("workspace")
-    os.mkdir("workspace/repos")
-    os.mkdir("workspace/build")
-    os.mkdir("workspace/output")
+    os.makedirs("workspace/build", exist_ok=True)
+    for folder in ["repos", "output"]:
+        if os.path.exists(f"workspace/{folder}"):
+            trash.discard(f"workspace/{folder}")
+        os.mkdir(f"workspace/{folder}")
 
 def fetch_pkgbuilds():
-    if os.path.exists("local"):
-        os.system(f"rm -rf local")
-    
-    ret = os.system("git clone --recursive https://github.com/MolyuuOS/PKGBUILD.git local")
-    if ret != 0:
+    try:
+        GitMirrorCache(f"{CACHE_DIR}/git").checkout(PKGBUILD_URL, "local", recursive=True)
+    except Exception:
         print("Failed to fetch PKGBUILDs.")
         raise Exception("Failed to fetch PKGBUILDs.")
 
-def main(sign: bool = False, password: str = ""):
-    fetch_pkgbuilds()
-    prepare_workspace()
+def git_remote_head(url: str) -> str:
+    """
+    Returns the commit the HEAD of a remote git repository points to, without fetching the repository.
+    """
+    ret = subprocess.run(["git", "ls-remote", url, "HEAD"], capture_output=True, text=True, timeout=60)
+    if ret.returncode != 0 or ret.stdout.strip() == "":
+        raise Exception(f"Failed to query {url}.")
+    return ret.stdout.split()[0]
+
+
+def compute_fingerprint(manifest: Manifest, repos: Optional[dict] = None,
+                        aur_resolver: Optional[AurResolver] = None) -> dict:
+    """
+    Fingerprints every input of a run: the manifest and this script, the versions of the fetched packages,
+    the last modification of the AUR packages and the heads of the remote and PKGBUILD git repositories.
+    The inputs are queried concurrently, databases only download again when they changed upstream.
+
+    Parameters:
+        manifest: The manifest of the run.
+        repos: The repositories already initialized for the run, initialized here if None.
+        aur_resolver: The AUR resolver of the run, whose cache is refreshed.
+
+    Returns:
+        dict: A dictionary mapping each input to its fingerprint.
+    """
+    fingerprint = {"manifest": file_sha256(manifest.path), "builder": file_sha256(os.path.abspath(__file__))}
+    if aur_resolver is None:
+        aur_resolver = AurResolver(AUR_URL, f"{CACHE_DIR}/aur/info.json", None)
+
+    with ThreadPoolExecutor(max_workers=FETCH_JOBS) as executor:
+        urls = [PKGBUILD_URL] + [package_def["url"] for package_def in manifest.get_build_list("remote") or []]
+        heads = {url: executor.submit(git_remote_head, url) for url in urls}
+        aur = executor.submit(aur_resolver.query, manifest.get_build_list("aur") or [], 0)
+        if repos is None:
+            repos = {name: executor.submit(Repository, name, url) for name, url in manifest.repos.items()}
+            repos = {name: future.result() for name, future in repos.items()}
+
+        for name, repo in repos.items():
+            versions = {}
+            for package in manifest.get_packages(name) or []:
+                names = [package] + ([f"{package}-debug"] if manifest.fetch_debug != "off" else [])
+                for package_name in names:
+                    package_info = repo.find_package(package_name)
+                    if package_info is not None:
+                        versions[package_name] = f"{package_info['version']} {package_info.get('sha256sum')}"
+            fingerprint[f"repo {name}"] = versions
+
+        fingerprint["aur"] = {name: result["LastModified"] if result is not None else None
+                              for name, result in aur.result().items()}
+        for url, head in heads.items():
+            fingerprint[f"git {url}"] = head.result()
+
+    return fingerprint
+
+
+def save_fingerprint(fingerprint: dict):
+    """
+    Stores the fingerprint of a successful run for check() to compare against.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(FINGERPRINT_PATH)), exist_ok=True)
+    with open(f"{FINGERPRINT_PATH}.tmp", "w") as f:
+        json.dump(fingerprint, f, indent=4, sort_keys=True)
+    os.replace(f"{FINGERPRINT_PATH}.tmp", FINGERPRINT_PATH)
+
+
+def check() -> bool:
+    """
+    Checks whether any input changed since the last successful run, printing the inputs that changed.
+    Packages whose inputs did not change are reused by the run itself, from the published repository and the build cache.
+
+    Returns:
+        bool: True if a run is needed.
+    """
     manifest = Manifest("manifest.json")
     manifest.load()
+    fingerprint = compute_fingerprint(manifest)
+
+    previous = {}
+    if os.path.exists(FINGERPRINT_PATH):
+        with open(FINGERPRINT_PATH, "r") as f:
+            previous = json.load(f)
 
-    package_getter = PackageGetter(manifest)
-    package_getter.fetch_packages_from_repos()
-    package_getter.build_packages()
+    changed = []
+    for key in sorted(set(fingerprint.keys()) | set(previous.keys())):
+        current, last = fingerprint.get(key), previous.get(key)
+        if isinstance(current, dict) and isinstance(last, dict):
+            changed += [f"{key}: {name}" for name in sorted(set(current.keys()) | set(last.keys()))
+                        if current.get(name) != last.get(name)]
+        elif current != last:
+            changed.append(key)
 
-    build_repository(manifest.name, sign, password)
+    if len(changed) == 0:
+        print("Nothing changed since the last successful run.")
+        return False
+
+    print("Changed since the last successful run:\n  " + "\n  ".join(changed))
+    return True
+
+
+def main(sign: bool = False, password: str = ""):
+    try:
+        with tracer.span("main", "run"):
+            trash.empty()
+            prepare_workspace()
+            manifest = Manifest("manifest.json")
+            manifest.load()
+
+            signer = Signer(password, f"{CACHE_DIR}/signatures") if sign and password != "" else None
+            # The stages only wait for their own inputs: PKGBUILDs are checked out while the repositories
+            # initialize, and binary packages download while the sources are fetched and built
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                pkgbuilds = executor.submit(fetch_pkgbuilds)
+                package_getter = PackageGetter(manifest, signer)
+                binaries = executor.submit(package_getter.fetch_packages_from_repos)
+                # Fingerprint the inputs as the run starts, so changes landing during the run trigger the next one
+                fingerprint = executor.submit(compute_fingerprint, manifest, package_getter.repos,
+                                              package_getter.aur_resolver)
+
+                pkgbuilds.result()
+                # A package failing to fetch fails the run without waiting for every build to finish
+                package_getter.build_packages([binaries])
+                binaries.result()
+            package_getter.wait_debug_packages()
+
+            build_repository(manifest.name, sign, password, signer, package_getter.digests)
+            try:
+                save_fingerprint(fingerprint.result())
+            except Exception as e:
+                print(f"Failed to fingerprint the inputs of the run: {e}")
+    finally:
+        tracer.report(f"{CACHE_DIR}/traces/trace-{time.strftime('%Y%m%d-%H%M%S')}.json",
+                      f"{CACHE_DIR}/traces/history.jsonl")
 
 
 if __name__ == "__main__":
     argv = sys.argv
-    if len(argv) == 3 and argv[1] == "--sign":
+    if len(argv) == 2 and argv[1] == "--check":
+        changed = check()
+        if os.getenv("GITHUB_OUTPUT") is not None:
+            with open(os.getenv("GITHUB_OUTPUT"), "a") as f:
+                f.write(f"changed={'true' if changed else 'false'}\n")
+    elif len(argv) == 3 and argv[1] == "--sign":
         main(True, argv[2])
     else:
         main()